@@ -0,0 +1,166 @@
+# All our readings history as one array per metric, indexed by absolute 5-minute slot, so that years of data can be sliced without
+# parsing any JSON. The arrays are .npy files which are memory-mapped, so a slice doesn't copy anything.
+# Slots with no reading are NaN. cheap_rate is 1.0 or 0.0.
+#
+# The daily readings files (read via filer, so journals are included) remain the master copy. update() brings the archive up to date
+# with them, using a manifest of the signature of each day's files so that only new or changed days are re-read. If METRICS changes,
+# the archive is rebuilt.
+#
+# python archive.py     Update the archive, then show what's in it
+
+import os
+import json
+import math
+import datetime
+from pathlib import Path
+import numpy as np
+import filer
+
+ARCHIVE_DIR = "../bc_archive/"
+MANIFEST_FILE = ARCHIVE_DIR + "manifest.json"
+START_DATE = "2022-01-01"   # Slot 0 starts at midnight UTC on this date
+START_EPOCH = 1640995200
+SLOT_S = 5 * 60             # Same as main.READINGS_INTERVAL_S
+SLOTS_PER_DAY = int((60*60*24) / SLOT_S)
+GROW_DAYS = 366             # Arrays grow by this much at a time
+
+METRICS = ["pv", "house", "import", "export", "batt charge", "batt discharge", "battery %", "batt%change", "cheap_rate", "house pv",
+           "import cost at cheap", "import cost at expensive", "pv savings", "import savings"]
+
+ARRAYS = {} # Read-only memory-maps, by metric
+
+def metric_filename(metric):
+    return ARCHIVE_DIR + metric.replace(" ", "_").replace("%", "percent") + ".npy"
+
+def date_to_day(date):
+    return (datetime.date.fromisoformat(date) - datetime.date.fromisoformat(START_DATE)).days
+
+def date_to_slot(date):
+    return date_to_day(date) * SLOTS_PER_DAY
+
+def slot_to_epoch(slots):
+    # Start of the slot(s)
+    return START_EPOCH + np.asarray(slots, dtype=np.int64) * SLOT_S
+
+def epoch_to_slot(epochs):
+    return (np.asarray(epochs, dtype=np.int64) - START_EPOCH) // SLOT_S
+
+def load_manifest():
+    if os.path.exists(MANIFEST_FILE):
+        try:
+            return json.loads(open(MANIFEST_FILE,"rt").read())
+        except ValueError:
+            print("Could not read archive manifest, so will rebuild the archive")
+    return { "slots" : 0, "days" : {}, "metrics" : METRICS }  # days is { date : filer.signature() }
+
+def save_manifest(manifest):
+    Path(ARCHIVE_DIR).mkdir(parents=True, exist_ok=True)
+    filer.replace_file(MANIFEST_FILE, json.dumps(manifest).encode())
+
+def grow(metric, slots, old_slots):
+    # Replace the metric's array with a bigger one (new slots are NaN)
+    Path(ARCHIVE_DIR).mkdir(parents=True, exist_ok=True)
+    fname = metric_filename(metric)
+    new = np.lib.format.open_memmap(fname + ".tmp", mode="w+", dtype=np.float64, shape=(slots,))
+    new[:] = np.nan
+    if old_slots > 0:
+        new[:old_slots] = np.load(fname, mmap_mode="r")[:old_slots]
+    new.flush()
+    del new
+    os.replace(fname + ".tmp", fname)
+
+def day_arrays(readings):
+    # Returns a (len(METRICS), SLOTS_PER_DAY) array from a day's readings
+    result = np.full((len(METRICS), SLOTS_PER_DAY), np.nan)
+    for r in readings:
+        n = r.get("reading_number")
+        if (n is None) or (n < 0) or (n >= SLOTS_PER_DAY):
+            continue
+        for (i, metric) in enumerate(METRICS):
+            if metric in r:
+                result[i, n] = float(r[metric])
+    return result
+
+def update():
+    # Bring the archive up to date with the readings files. Returns how many days changed.
+    manifest = load_manifest()
+    if manifest.get("metrics") != METRICS:
+        print("Archive metrics have changed, so rebuilding it")
+        manifest = { "slots" : 0, "days" : {}, "metrics" : METRICS }
+    names = [name for name in filer.list_names("readings") if date_to_day(name) >= 0]
+    changed = [name for name in names if manifest["days"].get(name) != filer.signature("readings", name)]
+    removed = [name for name in manifest["days"] if name not in names]
+    if len(changed) + len(removed) == 0:
+        return 0
+
+    needed = max([date_to_day(name) + 1 for name in changed] + [0]) * SLOTS_PER_DAY
+    if needed > manifest["slots"]:
+        slots = math.ceil(needed / (GROW_DAYS * SLOTS_PER_DAY)) * GROW_DAYS * SLOTS_PER_DAY
+        for metric in METRICS:
+            grow(metric, slots, manifest["slots"])
+        manifest["slots"] = slots
+    ARRAYS.clear()  # Any maps we have may be of the old files
+
+    arrays = [np.load(metric_filename(metric), mmap_mode="r+") for metric in METRICS]
+    for name in changed + removed:
+        if name in changed:
+            signature = filer.signature("readings", name)  # Before reading, so if it changes meanwhile we'll pick that up next time
+            day = day_arrays(filer.read_file("readings", name)["readings"])
+            manifest["days"][name] = signature
+        else:
+            day = np.full((len(METRICS), SLOTS_PER_DAY), np.nan)
+            del manifest["days"][name]
+        first = date_to_slot(name)
+        for (i, a) in enumerate(arrays):
+            a[first : first+SLOTS_PER_DAY] = day[i]
+    for a in arrays:
+        a.flush()
+    save_manifest(manifest)     # Last, so if we're interrupted the days we were working on get done again
+    print("Archived",len(changed),"days, removed",len(removed),"days")
+    return len(changed) + len(removed)
+
+def load(metric):
+    # The whole array for a metric, memory-mapped read-only
+    if metric not in ARRAYS:
+        fname = metric_filename(metric)
+        ARRAYS[metric] = np.load(fname, mmap_mode="r") if os.path.exists(fname) else np.zeros(0)
+    return ARRAYS[metric]
+
+def dates():
+    # Dates with readings in the archive
+    return sorted(load_manifest()["days"])
+
+def end_slot():
+    # Slots from here on are all NaN
+    days = load_manifest()["days"]
+    if len(days) == 0:
+        return 0
+    return (date_to_day(max(days)) + 1) * SLOTS_PER_DAY
+
+def slots(metric, first_slot, end_slot):
+    # Slots first_slot..end_slot-1 of a metric, without copying if possible. Slots beyond the archive are NaN.
+    a = load(metric)
+    if (first_slot >= 0) and (end_slot <= len(a)):
+        return a[first_slot:end_slot]
+    result = np.full(end_slot - first_slot, np.nan)
+    first, end = max(first_slot, 0), min(end_slot, len(a))
+    if end > first:
+        result[first-first_slot : end-first_slot] = a[first:end]
+    return result
+
+def day(metric, date):
+    first = date_to_slot(date)
+    return slots(metric, first, first + SLOTS_PER_DAY)
+
+if __name__ == "__main__":
+    import time
+    t1 = time.time()
+    update()
+    print("Update took %1.3fs" % (time.time()-t1))
+    end = end_slot()
+    t1 = time.time()
+    for metric in METRICS:
+        a = slots(metric, 0, end)
+        valid = ~np.isnan(a)
+        print("%-16s %8d readings, total %10.1f" % (metric, valid.sum(), np.nansum(a)))
+    print("Full scan of",end,"slots took %1.3fs" % (time.time()-t1))
@@ -0,0 +1,111 @@
+# Predicts household consumption for each 3h bin of a day, from running sums & weights per (weekday, month, bin)
+# Recent behaviour counts for more: each day's contribution decays by DECAY per day. Rather than rescanning history to do that,
+# when a newer day arrives we scale all the existing sums & weights down in one go, so adding a day is always O(1).
+
+import os
+import sys, traceback
+import pickle
+import datetime
+from pathlib import Path
+import numpy as np
+
+CACHE_DIR = "../bc_cache/"
+PROFILE_FILE = CACHE_DIR + "consumption_profile.pkl"
+BINS_PER_DAY = 8    # 3H each
+DECAY = 0.99        # Per day, so a day's weight halves in about 10 weeks
+MIN_WEIGHT = 0.5    # Less (decayed) data than this in a profile cell and we fall back to a broader average
+
+PROFILE = None  # See empty_profile()
+
+def empty_profile():
+    return {
+        "sums" : np.zeros((7, 12, BINS_PER_DAY)),       # By weekday, month, bin
+        "weights" : np.zeros((7, 12, BINS_PER_DAY)),
+        "latest" : None,    # Day number (see day_number()) that the sums & weights are currently decayed to
+        "days" : {}         # For each day added, { "fingerprint", "house" } so that it can be taken out again if its file changes
+        }
+
+def day_number(ymd):
+    return datetime.date.fromisoformat(ymd).toordinal()
+
+def cell(ymd):
+    d = datetime.date.fromisoformat(ymd)
+    return d.weekday(), d.month-1
+
+def load():
+    global PROFILE
+    if PROFILE is None:
+        PROFILE = empty_profile()
+        if os.path.exists(PROFILE_FILE):
+            try:
+                PROFILE = pickle.loads(open(PROFILE_FILE, "rb").read())
+            except Exception:
+                print("Could not load consumption profile, so will rebuild it")
+                traceback.print_exc(file=sys.stdout)
+    return PROFILE
+
+def save():
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    open(PROFILE_FILE + ".tmp", "wb").write(pickle.dumps(load()))
+    os.replace(PROFILE_FILE + ".tmp", PROFILE_FILE)    # Atomic, so we never load a half-written profile
+
+def _accumulate(profile, ymd, house, sign):
+    n = day_number(ymd)
+    if profile["latest"] is None:
+        profile["latest"] = n
+    elif n > profile["latest"]:
+        scale = DECAY ** (n - profile["latest"])
+        profile["sums"] *= scale
+        profile["weights"] *= scale
+        profile["latest"] = n
+    weight = sign * DECAY ** (profile["latest"] - n)    # Older days (e.g. arriving out of order) count for less
+    weekday, month = cell(ymd)
+    profile["sums"][weekday, month] += weight * np.asarray(house, dtype=float)
+    profile["weights"][weekday, month] += weight
+
+def add_day(ymd, fingerprint, house):
+    # Add (or replace) one day's binned consumption. Returns True if the profile changed.
+    profile = load()
+    if ymd in profile["days"]:
+        if profile["days"][ymd]["fingerprint"] == fingerprint:
+            return False
+        remove_day(ymd)
+    _accumulate(profile, ymd, house, 1)
+    profile["days"][ymd] = { "fingerprint" : fingerprint, "house" : list(house) }
+    return True
+
+def remove_day(ymd):
+    profile = load()
+    _accumulate(profile, ymd, profile["days"][ymd]["house"], -1)
+    del profile["days"][ymd]
+    np.maximum(profile["weights"], 0, out=profile["weights"])   # Don't let rounding leave tiny negative weights
+
+def days():
+    return load()["days"]
+
+def predict(ymd):
+    # Expected consumption per bin on the given date. Falls back from that weekday in that month, to that month, to that weekday, to all days.
+    profile = load()
+    sums, weights = profile["sums"], profile["weights"]
+    weekday, month = cell(ymd)
+    candidates = [
+        (sums[weekday, month], weights[weekday, month]),
+        (sums[:, month].sum(axis=0), weights[:, month].sum(axis=0)),
+        (sums[weekday].sum(axis=0), weights[weekday].sum(axis=0)),
+        (sums.sum(axis=(0,1)), weights.sum(axis=(0,1)))
+        ]
+    result = np.zeros(BINS_PER_DAY)
+    done = np.zeros(BINS_PER_DAY, dtype=bool)
+    for (s, w) in candidates:
+        use = (~done) & (w >= MIN_WEIGHT)
+        result[use] = s[use] / w[use]
+        done |= use
+    if not done.all():
+        print("Not enough consumption history to predict",(~done).sum(),"bins")
+    return [float(v) for v in result]
+
+if __name__ == "__main__":
+    # Show the profile for the coming week
+    for i in range(7):
+        ymd = (datetime.date.today() + datetime.timedelta(days=i)).isoformat()
+        print(ymd, " ".join(["%5.2f" % v for v in predict(ymd)]), "total %5.2f" % sum(predict(ymd)))
@@ -1,12 +1,12 @@
-# Dump the daily readings files into a CSV
+# Dump the readings archive (see archive.py) into a CSV, by half-hour
 
-import json
-import glob
 from datetime import datetime, timezone
 import numpy
+import archive
 
-START_EPOCH = datetime.fromisoformat("2022-01-01T00:00:00").timestamp() # All half-hours held internally relative to this date
-END_EPOCH = datetime.fromisoformat("2025-01-01T00:00:00").timestamp() # Needed so we can pre-allocate our Numpy arrays
+START_EPOCH = archive.START_EPOCH  # All half-hours held internally relative to this date
+END_EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp() # Needed so we can pre-allocate our Numpy arrays
+SLOTS_PER_HH = int((60*30) / archive.SLOT_S)
 
 def epoch_to_UTC_HH(epoch):
     return int((epoch-START_EPOCH) / (60*30))
@@ -17,36 +17,18 @@ def hh_to_epoch(hh):
 def total_hhs():
     return epoch_to_UTC_HH(END_EPOCH)
 
-def process(fname, fn):
-    f = json.loads(open(fname,"rt").read())
-    for reading in f["readings"]:
-        if "end" not in reading:
-            continue
-        epoch = reading["end"]
-        for (k,v) in reading.items():
-            fn(epoch_to_UTC_HH(epoch), k,v)
-
-def dokey(reading):
-    if "reading_number" in reading:
-        return reading["reading_number"]
-    return 0
-
-DIR = {}    # A dict of key names, each of which holds an array indexed by half-hour
-
-def insert_key(HH,k,v):
-    global DIR
-    if k not in DIR:
-        DIR[k] = numpy.zeros(total_hhs())
-    DIR[k][HH] += v
+def by_hh(metric):
+    # Sum of the metric in each half-hour (0 if no readings)
+    slots = archive.slots(metric, 0, total_hhs() * SLOTS_PER_HH)
+    return numpy.nansum(slots.reshape(-1, SLOTS_PER_HH), axis=1)
 
 if __name__ == "__main__":
-    files = sorted(list(glob.glob('../bc_data/readings*.json')))
-    print("Processing",len(files),"readings files")
-    print("Earliest",files[0])
-    print("Latest  ",files[-1])
-    for name in files: 
-        print(name)
-        process(name, insert_key)
+    archive.update()
+    dates = archive.dates()
+    print("Processing",len(dates),"days of readings")
+    print("Earliest",dates[0])
+    print("Latest  ",dates[-1])
+    DIR = { metric : by_hh(metric) for metric in archive.METRICS }    # A dict of metric names, each of which holds an array indexed by half-hour
 
     print("Datetime,HH,", end='')
     for k in DIR.keys():
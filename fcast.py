@@ -3,25 +3,28 @@
 # TODO: Add inverter inefficiency. Debug behaviour with very small inverter and very large battery (leads to negative savings, why?)
 
 import os
-import json
+import sys
 import random
 import math
 from datetime import datetime
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import numpy as np
 from scipy.interpolate import griddata
 from scipy.stats import binned_statistic_2d
 import cv2
 import glob
-from astropy.time import Time
-from astropy.coordinates import get_sun, EarthLocation, AltAz
-import astropy.units as astro_units
+import multiprocessing
+import solar
+import pricestore
+import archive
+from hhseries import HalfHourSeries
 
 earliest_date = "2023-01-01T00:00:00"   # This must be the start of a day
 latest_date = "2023-12-31T23:59:59"
-readings_dir = "../bc_data/"
 plots_dir = "/mnt/c/Users/PilgrimBeart/Desktop/plots/"
-price_file = "2023_agile.csv"
+price_files = ["2023_agile.csv"]    # e.g. one per year
 
 HALF_AN_HOUR_S = 60*30
 
@@ -32,150 +35,117 @@ LATITUDE =  52.13674 # Pilgrim's home at Harston, Cambridge UK
 LONGITUDE = 0.07688
 
 OUTPUT_PLOTS = True
+STREAM_PLOTS = True # Render plots straight into the video, rather than saving a PNG per day and reading them back
+PLOT_DPI = 300
+FRAMES = []         # Data for each plot, when STREAM_PLOTS
 BATT_KWH_PER_HH = BATTERY_KW / 2    # How much charge can move in a HH
+SWEEP_INVERTER_KW = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]    # Sizes tried by "python fcast.py sweep"
+SWEEP_BATTERY_KWH = [2, 4, 6, 8, 10, 12, 14, 16, 18, 20]
+SCENARIOS_PER_DAY = 500   # Monte-Carlo usage scenarios per day for "python fcast.py robust"
+ROBUST_USAGE_SCALES = [0.75, 1.0, 1.25] # plan_robustly() plans for the average usage profile scaled by each of these
+DP_KWH_STEP = 0.01  # Battery state-of-charge resolution used by plan_modes_dp()
 
 def to_half_hour(date_str):
     return int(datetime.fromisoformat(date_str).timestamp() / HALF_AN_HOUR_S)
 earliest_hh = to_half_hour(earliest_date)
 latest_hh = to_half_hour(latest_date)
 
-def hhs_of_None():
-    # Create a dict containing all the expected hh values within the range, all containing None (so if we never see any data at this HH, we know there is missing data)
-    d = {}
-    for hh in range(earliest_hh,latest_hh):
-        d[hh] = None
-    return d
+def empty_hh_series():
+    # A series with a slot for every expected hh within the range, none of them valid yet (so if we never see any data at this HH, we know there is missing data)
+    return HalfHourSeries(earliest_hh, latest_hh-earliest_hh)
 
 def get_readings():
     # Get house consumption, by half-hour, for the range in question
     print("Getting household readings")
-    kWh_used_by_hh = hhs_of_None()
-
-    total_batt_charge = 0   # Nothing to do with the primary function of this function, just put this here to do some battery usage analysis
-    total_batt_discharge = 0
-
-
-    azi_elev_pv = []
-    for filename in os.listdir(readings_dir): 
-        print(filename)
-        f = os.path.join(readings_dir,filename)
-        if not os.path.isfile(f):
-            continue
-        if not ("readings" in f):
-            continue
-        contents = json.loads(open(f).readlines()[0])
-        if not "readings" in contents:
-            print("no readings, skipping", contents.keys())
-            continue
-        for r in contents["readings"]:
-            if not "end" in r:
-                continue
-            if filename.startswith("readings_2023"):
-                #if "pv" in r:
-                #    pv = r["pv"]
-                #    if pv > 0:
-                if ("batt charge" in r) and ("batt discharge" in r):
-                    pv = r["batt charge"] - r["batt discharge"]
-                    azi,elev = epoch_to_azi_elev(r["end"])  # Nothing to do with purpose of this function, just grabbing some solar data
-                    if pv > 0:
-                        pv = 1.0
-                    if pv < 0:
-                        pv = -1.0
-                    azi_elev_pv.append((azi,elev,pv))
-                    # print("%3f %3f %3.1f" % (azi,elev,pv))
-            hh = int(r["end"] / HALF_AN_HOUR_S) 
-            if (hh >= earliest_hh) and (hh < latest_hh):
-                if kWh_used_by_hh[hh] is None:
-                    kWh_used_by_hh[hh] = r["house"]
-                else:
-                    kWh_used_by_hh[hh] += r["house"]
-                total_batt_charge += r["batt charge"]
-                total_batt_discharge += r["batt discharge"]
-                # print((hh-earliest_hh) % 48,r["batt charge"], r["batt discharge"])
+    kWh_used_by_hh = empty_hh_series()
+
+    archive.update()
+    end = archive.end_slot()
+    house = archive.slots("house", 0, end)
+    batt_charge = archive.slots("batt charge", 0, end)    # Nothing to do with the primary function of this function, just put this here to do some battery usage analysis
+    batt_discharge = archive.slots("batt discharge", 0, end)
+    epochs = archive.slot_to_epoch(np.arange(end))
+    reading_hhs = epochs // HALF_AN_HOUR_S
+    has_house = ~np.isnan(house)
+
+    kWh_used_by_hh.add(reading_hhs[has_house], house[has_house])
+    in_range = has_house & (reading_hhs >= earliest_hh) & (reading_hhs < latest_hh)
+    total_batt_charge = np.nansum(batt_charge[in_range])
+    total_batt_discharge = np.nansum(batt_discharge[in_range])
 
     print("Within given range found",len(kWh_used_by_hh),"half-hours")
-    kWh = 0
-    missing_hhs = 0
-    for k in sorted(kWh_used_by_hh.keys()):
-        # print(k,",",kWh_used_by_hh[k])
-        if kWh_used_by_hh[k] is not None:
-            kWh += kWh_used_by_hh[k]
-        else:
-            missing_hhs += 1
-    print(kWh,"house kWh total")
-    print(missing_hhs,"missing half hours of data")
+    print(kWh_used_by_hh.total(),"house kWh total")
+    print(kWh_used_by_hh.missing(),"missing half hours of data")
 
     print("Total batt usage: Charge",total_batt_charge,"Discharge",total_batt_discharge)
+    # Grab some solar data: whether the battery was charging (1) or discharging (-1) at each reading in 2023
+    in_2023 = np.zeros(end, dtype=bool)
+    in_2023[archive.date_to_slot("2023-01-01") : archive.date_to_slot("2024-01-01")] = True
+    has_batt = in_2023 & ~np.isnan(batt_charge) & ~np.isnan(batt_discharge)
+    batt_pv = np.sign(batt_charge[has_batt] - batt_discharge[has_batt])
+    azi, elev = solar.epochs_to_azi_elev(epochs[has_batt], LATITUDE, LONGITUDE)
+    azi_elev_pv = np.column_stack((azi, elev, batt_pv))
     return kWh_used_by_hh, azi_elev_pv
 
 def daily_profile(kWh_hhs):
     # Given HH readings over some time range, find the average consumption per HH
-    kWh_per_hh = [0] * 48
-    entries_per_hh = [0] * 48
-    for hh in range(earliest_hh,latest_hh):
-        daily_hh = (hh - earliest_hh) % 48
-        v = kWh_hhs[hh]
-        if v is not None:
-            kWh_per_hh[daily_hh] += v
-            entries_per_hh[daily_hh] += 1
-
-    for hh in range(48):
-        kWh_per_hh[hh] /= entries_per_hh[hh]
-
-    return kWh_per_hh
+    return kWh_hhs.daily_profile().tolist()
 
 def get_prices():
-    # Price file is assumed to be in pence/kWh (i.e. Octopus Agile prices, not NG pricing which is in GBP/MWh)
+    # Price files are assumed to be in pence/kWh (i.e. Octopus Agile prices, not NG pricing which is in GBP/MWh)
     print("Getting price data")
-    tot=0
-    count=0
-    price_by_hh = hhs_of_None()
-    ignored = 0
-    for l in open(price_file).readlines():
-        d,v = l.split(",")
-        hh = to_half_hour(d)
-        v = float(v)
-        # print(hh,",",v)
-        if (hh < earliest_hh) or (hh >= latest_hh):
-            print("Ignoring hh",hh,"which is outside time range")
-            ignored += 1
-            continue
-        if price_by_hh[hh] is not None:
-            print("Duplicate half-hour")
-        price_by_hh[hh] = v
-        if v > 70:
-            print("Excessively High",v)
-        if v < -20:
-            print("Excessively Low",v)
-        tot += v
-        count += 1
+    price_by_hh = empty_hh_series()
+    ignored, duplicates = pricestore.load_prices(price_files, price_by_hh)
+    if duplicates > 0:
+        print(duplicates,"duplicate half-hours")
     print("Ignored",ignored,"prices outside time range")
-    print("Read",count,"prices which averaged",tot/count)
+    v = price_by_hh.values[price_by_hh.valid]
+    print((v > 70).sum(),"excessively high prices and",(v < -20).sum(),"excessively low")
+    print("Read",len(v),"prices which averaged",price_by_hh.mean())
     return price_by_hh
     
-def decide_inverter_function(hh):
-    # What should the inverter do for this HH? Import, Export or Self-consume
+def price_visibility_hhs(hh):
+    # How many HHs of prices (starting with this one) do we know at this HH?
     # Octopus publish Agile prices at 4pm (HH=32) for the day ahead.
     # So at that point we still have 8h of this day (from previous day's forecast) + 24h new visibility = 64HH.
     # This then falls to 8h (16HH) visibility over the next 24h
     hh_in_day = (hh - earliest_hh) % 48
-    forward_visibility_hhs = (48-hh_in_day+31) % 48 + 17    # A sawtooth which starts at 64 at 4pm then falls down to 16 just before next 4pm
-    # print(hh_in_day,forward_visibility_hhs)
-
-def run_scenario(initial_battery_kWh, kWh_used_by_hh, price_by_hh):
+    return (48-hh_in_day+31) % 48 + 17    # A sawtooth which starts at 64 at 4pm then falls down to 16 just before next 4pm
+
+def run_scenario(initial_battery_kWh, kWh_used_by_hh, price_by_hh, daily_kWh_profile):
+    # Receding-horizon simulation: every HH we re-plan using only the prices visible at that moment (and the average usage profile), then carry out just the first HH of the plan against actual usage.
+    # Each plan is warm-started from the previous one, shifted along by a HH. When a new day's prices are published we plan afresh with plan_modes_dp().
+    print("Running receding-horizon scenario")
+    profile = np.array(daily_kWh_profile)
+    battery_kWh = initial_battery_kWh
     total_cost = 0
-    battery_state_kWh = 0 # Battery starts empty
-    for hh in range(earliest_hh,latest_hh):
-        kWh_used = kWh_used_by_hh[hh]
-        price = price_by_hh[hh]
-        inverter_function = decide_inverter_function(hh)
-        if (kWh_used is None) or (price is None):
-            print("Ignoring missing data at hh",hh)
-            continue
-        cost = price * kWh_used
-        # print(kWh_used, price, cost)
-        total_cost += cost
-    print("Total cost GBP",total_cost/100)
+    (used, priced) = kWh_used_by_hh.join(price_by_hh)   # What we'd have paid with no battery, over the half-hours for which we know both
+    total_cost_unabated = float((used.values * priced.values)[used.valid].sum())
+    inverter_modes = []
+    for hh in range(earliest_hh, latest_hh):
+        horizon = min(price_visibility_hhs(hh), latest_hh-hh)
+        prices = price_by_hh.day(hh, horizon)
+        kWh_forecast = profile[(np.arange(hh, hh+horizon) - earliest_hh) % 48]
+        kWh_value = prices.mean()
+        def fitness_function(inverter_modes):
+            cost, new_batt_kWh = run_plans(battery_kWh, kWh_forecast, prices, inverter_modes)
+            return (new_batt_kWh - battery_kWh) * kWh_value - cost
+        if horizon > len(inverter_modes)-1:    # New prices have been published (or this is the first HH)
+            inverter_modes = plan_modes_dp(battery_kWh, kWh_forecast, prices, kWh_value)
+        else:
+            inverter_modes = inverter_modes[1:horizon+1]
+        inverter_modes = hill_climb(fitness_function, inverter_modes)
+
+        kWh_used = kWh_used_by_hh.day(hh, 1)
+        cost, battery_kWh = run_plans(battery_kWh, kWh_used, prices[:1], inverter_modes[:1])
+        battery_kWh = float(battery_kWh)
+        total_cost += float(cost)
+        if (hh-earliest_hh) % 48 == 47:
+            print("Day",int((hh-earliest_hh)/48),"cost so far",int(total_cost),"batt_kWh",battery_kWh)
+
+    total_savings = total_cost_unabated - total_cost
+    print("Receding horizon with inverter kW",BATTERY_KW,"and batt kWh",BATTERY_KWH,", total cost",int(total_cost),"total savings",int(total_savings),"cost+savings",int(total_cost_unabated),"so saved",100*total_savings/total_cost_unabated,"%")
+    return total_cost, total_savings, battery_kWh
 
 def create_random_inverter_modes():
     modes = []
@@ -240,7 +210,9 @@ def run_plan(battery_initial_kWh, kWh_used, prices, inverter_modes, title=None):
         arr_import_kWh.append(import_kWh)
         arr_cost.append(delta_cost)
 
-    if (title is not None) and OUTPUT_PLOTS:
+    if (title is not None) and OUTPUT_PLOTS and STREAM_PLOTS:  # Just remember the data, and render it in save_movie()
+        FRAMES.append((title, [list(kWh_used), list(prices), arr_cost_unabated, list(inverter_modes), arr_battery_kWh, arr_import_kWh, arr_cost]))
+    elif (title is not None) and OUTPUT_PLOTS:
         plot_it(kWh_used, "kWh_used", 0,5)
         plot_it(prices, "prices",0,50)
         plot_it(arr_cost_unabated, "cost unabatd",0,60)
@@ -249,24 +221,48 @@ def run_plan(battery_initial_kWh, kWh_used, prices, inverter_modes, title=None):
         plot_it(arr_import_kWh, "import_kWh",-4,5)
         plot_it(arr_cost, "cost",-200,200)
         plt.suptitle(title)
-        plt.savefig(plots_dir + "plot_" + "%03d" % plot_count, dpi=300)
+        plt.savefig(plots_dir + "plot_" + "%03d" % plot_count, dpi=PLOT_DPI)
         plot_count += 1
         plt.close()
 
     return cost, battery_kWh
 
+def run_plans(battery_initial_kWh, kWh_used, prices, inverter_modes):
+    # Batch version of run_plan(): inverter_modes is an (N,48) array of plans, and we return N costs and N final battery states.
+    # kWh_used and prices may be a single day or one day per plan. Leading dimensions broadcast, so (N,1,48) plans against (S,48) usage gives (N,S) results.
+    # The arithmetic is done in the same order as run_plan(), so results are bit-for-bit the same as calling it N times.
+    inverter_modes = np.asarray(inverter_modes)
+    kWh_used = np.asarray(kWh_used, dtype=float)
+    prices = np.asarray(prices, dtype=float)
+    if not np.isin(inverter_modes, (-1,0,1)).all():
+        raise ValueError("Unrecognised inverter mode")
+    shape = np.broadcast_shapes(inverter_modes.shape, kWh_used.shape, prices.shape)
+    plans_shape = shape[:-1] or (1,)    # A single plan is treated as a batch of one, so that the in-place operations below always have an array to work on
+    battery_kWh = np.broadcast_to(np.asarray(battery_initial_kWh, dtype=float), plans_shape).copy()
+    cost = np.zeros(plans_shape)
+    importing = np.moveaxis(inverter_modes == 1, -1, 0).copy()    # One contiguous row per HH
+    exporting = np.moveaxis(inverter_modes == -1, -1, 0).copy()
+    for hh in range(shape[-1]):
+        u = kWh_used[..., hh]
+        charge = BATTERY_KWH - battery_kWh                      # Import
+        np.minimum(charge, BATT_KWH_PER_HH, out=charge)
+        discharge = -battery_kWh                                # Export
+        np.maximum(discharge, -BATT_KWH_PER_HH, out=discharge)
+        delta = np.maximum(discharge, -u)                       # Balance
+        np.copyto(delta, charge, where=importing[hh])
+        np.copyto(delta, discharge, where=exporting[hh])
+        battery_kWh += delta
+        delta += u
+        delta *= prices[..., hh]
+        cost += delta
+    return cost.reshape(shape[:-1]), battery_kWh.reshape(shape[:-1])
+
 def plan_random(battery_initial_kWh, kWh_used, prices): # Create random plans and pick the best. Ineffective approach, because there are 3^48 possible plans, so needle in a haystack.
-    best_inverter_modes = [0] * 48
-    inverter_modes = best_inverter_modes
-    best_cost = 9e99
-    for i in range(10000):
-        inverter_modes = create_random_inverter_modes() 
-        cost = run_plan(battery_initial_kWh, kWh_used, prices, inverter_modes)
-        if cost < best_cost:
-            print(cost)
-            best_cost = cost
-            best_inverter_modes = inverter_modes
-    run_plan(battery_initial_kWh, kWh_used, prices, best_inverter_modes, True)
+    inverter_modes = np.random.randint(-1, 2, size=(10000, 48))
+    costs, __ = run_plans(battery_initial_kWh, kWh_used, prices, inverter_modes)
+    best = int(np.argmin(costs))
+    print(costs[best])
+    run_plan(battery_initial_kWh, kWh_used, prices, inverter_modes[best].tolist(), True)
 
 def plan_carefully(battery_initial_kWh, kWh_used, prices):  # Just charge battery once per day, in cheapest half-hours. Works but doesn't really take export or battery discharge into account
     inverter_modes = [0] * 48
@@ -284,38 +280,208 @@ def plan_carefully(battery_initial_kWh, kWh_used, prices):  # Just charge batter
     print("initial cost",int(initial_cost),"final cost",int(cost),"so saved",int(savings),"cost reduced to",int(100*cost/initial_cost),"%") # ignoring any (dis)benefit of change in battery state
     return cost, savings, batt_final_kWh
 
-def plan_do_one_thing(day, battery_initial_kWh, av_kWh_used, actual_kWh_used, prices):    # Find the best HH to change and iterate until can't improve. Risk of local minimum.
+def hill_climb(fitness_function, inverter_modes):    # Find the best HH to change and iterate until can't improve. Risk of local minimum.
+    # fitness_function takes an (N,HHs) array of plans and returns N fitnesses.
+    # Each sweep tries every HH in every state, in order, keeping each improvement as it is found. 
+    # Trials only depend on the plan at the time, so all the remaining trials of a sweep are scored in one batch, and we re-batch from just after each improvement.
+    trial_hhs = np.repeat(np.arange(len(inverter_modes)), 3)
+    trial_states = np.tile([-1,0,1], len(inverter_modes))
+    best_modes_so_far = np.array(inverter_modes)
+    best_fitness_so_far = fitness_function(best_modes_so_far[np.newaxis])[0]
+    for i in range(10000):
+        improved = False
+        first_trial = 0
+        while first_trial < len(trial_hhs):
+            hhs = trial_hhs[first_trial:]
+            trials = np.tile(best_modes_so_far, (len(hhs), 1))
+            trials[np.arange(len(hhs)), hhs] = trial_states[first_trial:]
+            fitness = fitness_function(trials)
+            better = np.flatnonzero(fitness > best_fitness_so_far)
+            if len(better) == 0:
+                break
+            best_modes_so_far = trials[better[0]]
+            best_fitness_so_far = fitness[better[0]]
+            first_trial += better[0] + 1
+            improved = True
+        if not improved:
+            break
+    return best_modes_so_far.tolist()
+
+def plan_do_one_thing(day, battery_initial_kWh, av_kWh_used, actual_kWh_used, prices):    # Hill-climb from "always balance"
     def fitness_function(inverter_modes): 
-        cost, new_batt_kWh = run_plan(battery_initial_kWh, av_kWh_used, prices, inverter_modes, None)
+        cost, new_batt_kWh = run_plans(battery_initial_kWh, av_kWh_used, prices, inverter_modes)
         return (new_batt_kWh - battery_initial_kWh) * av_cost - cost    # Increasing the battery charge is as valuable as reducing total cost
     av_cost = sum(prices) / len(prices)    # Plan fitness is a combination of 2 dimensions: 1) cost and 2) battery charge increase. We need a price to value the latter.
     inverter_modes = [0] * 48
     initial_cost, new_batt_kWh = run_plan(battery_initial_kWh, av_kWh_used, prices, inverter_modes, None)
-    initial_fitness = fitness_function(inverter_modes)
-    
-    best_fitness_so_far = initial_fitness
-    best_modes_so_far = inverter_modes.copy()
-    for i in range(10000):
-        best_fitness_this_iter = best_fitness_so_far
-        best_modes_this_iter = best_modes_so_far.copy()
-        for hh in range(48):
-            for state in range(-1,2):
-                trial_modes = best_modes_this_iter.copy()
-                trial_modes[hh] = state
-                fitness = fitness_function(trial_modes)
-                if fitness > best_fitness_this_iter:
-                    best_fitness_this_iter = fitness
-                    best_modes_this_iter = trial_modes.copy()
-        if best_fitness_this_iter > best_fitness_so_far:
-            best_fitness_so_far = best_fitness_this_iter
-            best_modes_so_far = best_modes_this_iter.copy()
-        else:
-            break
+    best_modes_so_far = hill_climb(fitness_function, inverter_modes)
                 
     final_cost, new_batt_kWh = run_plan(battery_initial_kWh, actual_kWh_used, prices, best_modes_so_far, "Day "+str(day))  # We planned ahead on the assumption of average daily usage profile. Now apply actual profile.
     return final_cost, initial_cost-final_cost, new_batt_kWh
 
+def plan_modes_dp(battery_initial_kWh, kWh_used, prices, kWh_value):
+    # Find the inverter modes which minimise cost - (final battery kWh * kWh_value), by dynamic programming over half-hours x battery state-of-charge.
+    # States are merged onto a grid of DP_KWH_STEP, but each grid cell keeps the exact battery level of the best path that reached it, so costs are never approximated.
+    # Work is bounded by 48 x 3 x (BATTERY_KWH/DP_KWH_STEP) regardless of prices.
+    batt = np.array([float(battery_initial_kWh)])   # Exact battery level of each surviving state
+    cost = np.array([0.0])                          # Cost of the best path to each surviving state
+    back_pointers = []
+    for hh in range(len(prices)):
+        u = kWh_used[hh]
+        p = prices[hh]
+        # Apply each mode to every surviving state, exactly as run_plan() does
+        charge = np.minimum(BATT_KWH_PER_HH, BATTERY_KWH-batt)                  # Import
+        export = np.maximum(-BATT_KWH_PER_HH, -batt)                            # Export
+        balance = np.maximum(np.maximum(-BATT_KWH_PER_HH, -batt), -u)           # Balance
+        new_batt = np.concatenate((batt + export, batt + balance, batt + charge))
+        import_kWh = np.concatenate((export + u, u + balance, charge + u))
+        new_cost = np.concatenate((cost, cost, cost)) + import_kWh * p
+        parents = np.tile(np.arange(len(batt)), 3)
+        modes = np.repeat([-1,0,1], len(batt))
+
+        # Keep only the cheapest state in each grid cell
+        cell = np.rint(new_batt / DP_KWH_STEP).astype(int)
+        order = np.lexsort((new_cost, cell))
+        first_in_cell = np.ones(len(order), dtype=bool)
+        first_in_cell[1:] = cell[order][1:] != cell[order][:-1]
+        keep = order[first_in_cell]
+
+        batt = new_batt[keep]
+        cost = new_cost[keep]
+        back_pointers.append((parents[keep], modes[keep]))
+
+    # Pick the best end state, then walk back through the half-hours to recover the modes which got us there
+    state = int(np.argmin(cost - batt * kWh_value))
+    inverter_modes = [0] * len(prices)
+    for hh in range(len(prices)-1, -1, -1):
+        parents, modes = back_pointers[hh]
+        inverter_modes[hh] = int(modes[state])
+        state = parents[state]
+    return inverter_modes
+
+def plan_optimally(day, battery_initial_kWh, av_kWh_used, actual_kWh_used, prices):    # Same fitness as plan_do_one_thing(), but planned globally by DP and then polished by hill-climbing
+    def fitness_function(inverter_modes): 
+        cost, new_batt_kWh = run_plans(battery_initial_kWh, av_kWh_used, prices, inverter_modes)
+        return (new_batt_kWh - battery_initial_kWh) * av_cost - cost
+    av_cost = sum(prices) / len(prices)
+    initial_cost, new_batt_kWh = run_plan(battery_initial_kWh, av_kWh_used, prices, [0] * 48, None)
+    inverter_modes = plan_modes_dp(battery_initial_kWh, av_kWh_used, prices, av_cost)
+    inverter_modes = hill_climb(fitness_function, inverter_modes) # DP merges nearby battery states, so make sure no single-HH change can still improve things
+
+    final_cost, new_batt_kWh = run_plan(battery_initial_kWh, actual_kWh_used, prices, inverter_modes, "Day "+str(day))
+    return final_cost, initial_cost-final_cost, new_batt_kWh
+
+def usage_distribution(kWh_used_by_hh):
+    # Historical usage for each half-hour of the day: a (days,48) array with each column's valid values packed at the top, and how many there are in each column
+    values, valid = kWh_used_by_hh.by_day()
+    order = np.argsort(~valid, axis=0, kind='stable')
+    return np.take_along_axis(values, order, axis=0), valid.sum(axis=0)
+
+def draw_scenarios(distribution, n, rng):
+    # n days of usage, with each half-hour drawn independently from the history of that half-hour of the day
+    packed, counts = distribution
+    rows = (rng.random((n, 48)) * counts).astype(int)
+    return packed[rows, np.arange(48)]
+
+def score_plans(battery_initial_kWh, scenarios, prices, inverter_modes):
+    # Run each of N plans against each of S usage scenarios, all in one go. Returns (N,S) arrays of costs and final battery states.
+    return run_plans(battery_initial_kWh, scenarios, prices, np.asarray(inverter_modes)[:, np.newaxis, :])
+
+def plan_robustly(day, battery_initial_kWh, av_kWh_used, actual_kWh_used, prices, scenarios):
+    # Plan for several usage levels, then pick whichever plan does best on average across all the scenarios
+    av_cost = sum(prices) / len(prices)
+    candidates = [[0] * 48] + [plan_modes_dp(battery_initial_kWh, np.array(av_kWh_used) * scale, prices, av_cost) for scale in ROBUST_USAGE_SCALES]
+    costs, new_batt_kWh = score_plans(battery_initial_kWh, scenarios, prices, candidates)
+    fitness = ((new_batt_kWh - battery_initial_kWh) * av_cost - costs).mean(axis=1)
+    best = int(np.argmax(fitness))
+    final_cost, new_batt_kWh = run_plan(battery_initial_kWh, actual_kWh_used, prices, candidates[best], "Day "+str(day))
+    return final_cost, costs[0].mean()-final_cost, new_batt_kWh, costs[best]
+
+def run_robust_year(kWh_used_by_hh, price_by_hh, daily_kWh_profile):
+    # Like run_year(), but plans are chosen and scored against SCENARIOS_PER_DAY Monte-Carlo usage scenarios per day, to show the expected cost and its spread
+    distribution = usage_distribution(kWh_used_by_hh)
+    rng = np.random.default_rng(0)
+    total_cost = 0
+    total_savings = 0
+    total_expected_cost = 0
+    total_variance = 0
+    batt_kWh = 0
+    for hh in range(earliest_hh, latest_hh-48, 48):    # One day at a time
+        prices = select_48_hhs(hh, price_by_hh)
+        actual_kWh = select_48_hhs(hh, kWh_used_by_hh)
+        day = int((hh-earliest_hh)/48)
+        scenarios = draw_scenarios(distribution, SCENARIOS_PER_DAY, rng)
+        cost, savings, batt_kWh, scenario_costs = plan_robustly(day, batt_kWh, daily_kWh_profile, actual_kWh, prices, scenarios)
+        p5, p95 = np.percentile(scenario_costs, [5, 95])
+        print("Day",day,"expected cost %1.0f +/- %1.0f (5%%-95%%: %1.0f to %1.0f), actual cost %1.0f" % (scenario_costs.mean(), scenario_costs.std(), p5, p95, cost))
+        total_cost += cost
+        total_savings += savings
+        total_expected_cost += scenario_costs.mean()
+        total_variance += scenario_costs.var()
+    print("Expected annual cost %1.0f +/- %1.0f, actual %1.0f, savings %1.0f" % (total_expected_cost, math.sqrt(total_variance), total_cost, total_savings))
+    return total_cost, total_savings, total_expected_cost, math.sqrt(total_variance)
+
+PLOT_PANELS = [ # Name, min_y, max_y of each subplot, in the order run_plan() stores series in FRAMES. None means BATTERY_KWH
+    ("kWh_used", 0, 5),
+    ("prices", 0, 50),
+    ("cost unabatd", 0, 60),
+    ("inverter", -1, 1),
+    ("batt_kWh", 0, None),
+    ("import_kWh", -4, 5),
+    ("cost", -200, 200)]
+
+plot_figure = None  # This process's figure, which is created once and then updated for each frame
+
+def create_plot_figure():
+    # Same layout as run_plan() draws, but built once so each frame only needs to change bar heights
+    figure = Figure(dpi=PLOT_DPI)
+    FigureCanvasAgg(figure)
+    bars = []
+    for i, (name, min_y, max_y) in enumerate(PLOT_PANELS):
+        ax = figure.add_subplot(7, 1, i+1)
+        bars.append(ax.bar(range(48), [0] * 48))
+        ax.grid(axis='x')
+        ax.set_xticks(range(0,48,4))
+        ax.tick_params(axis='y', labelsize=6)
+        ax.set_ylim(min_y, BATTERY_KWH if max_y is None else max_y)
+        ax2 = ax.twinx() # Create new Y axis on rhs
+        ax2.set_yticks([])  # Remove scale
+        ax2.set_ylabel(name, fontsize=6)
+        ax2.grid(which='minor', axis='x', linestyle='-', color='gray')
+    return figure, bars
+
+def render_frame(frame):
+    # Returns the frame as a BGR image, ready for cv2
+    global plot_figure
+    if plot_figure is None:
+        plot_figure = create_plot_figure()
+    figure, bars = plot_figure
+    title, series = frame
+    for bar_container, values in zip(bars, series):
+        for bar, v in zip(bar_container, values):
+            bar.set_height(v)
+    figure.suptitle(title)
+    figure.canvas.draw()
+    return cv2.cvtColor(np.asarray(figure.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+
+def stream_movie(frames):
+    # Render frames across all cores and write them straight into the video, with no image files in between
+    print("Creating video from",len(frames),"frames")
+    video = None
+    with multiprocessing.Pool() as pool:
+        for image in pool.imap(render_frame, frames, chunksize=4):    # imap hands back frames in their original order, whichever worker finishes first
+            if video is None:
+                height, width, layers = image.shape
+                video = cv2.VideoWriter(plots_dir + "video.mp4", cv2.VideoWriter_fourcc(*'mp4v'), 10, (width, height))
+            video.write(image)
+    if video is not None:
+        video.release()
+
 def save_movie():   # Save all plots as a movie
+    if STREAM_PLOTS:
+        stream_movie(FRAMES)
+        return
+
     # Directory containing images
     print("Creating video")
     images = [img for img in os.listdir(plots_dir) if img.endswith(".png")]
@@ -335,31 +501,18 @@ def save_movie():   # Save all plots as a movie
     cv2.destroyAllWindows()
     video.release()
 
-def select_48_hhs(start_hh, the_dict):  # Given a dict indexed by half-hour, find a days-worth of data and put it into a list. 
-    arr = []
-    for i in range(48):
-        idx = start_hh + i
-        if not idx in the_dict:
-            arr.append(0)   # Missing data replaced by 0 
-        elif the_dict[idx] is None:
-            arr.append(0)   # Missing data replaced by 0
-        else:
-            arr.append(the_dict[start_hh+i])
-    return arr
-
-def epoch_to_azi_elev(epoch):
-    location = EarthLocation(lat=LATITUDE*astro_units.deg, lon=LONGITUDE*astro_units.deg)
-    time = Time(epoch, format='unix')
-    altaz_frame = AltAz(obstime=time, location=location)
-    sun_position = get_sun(time).transform_to(altaz_frame)
+def select_48_hhs(start_hh, series):  # Given a series indexed by half-hour, find a days-worth of data and put it into a list. Missing data replaced by 0
+    return series.day(start_hh).tolist()
 
-    return float(sun_position.az.deg), float(sun_position.alt.deg)
+def epoch_to_azi_elev(epoch):    # Exact position for a single time. For many times use solar.epochs_to_azi_elev()
+    azi, elev = solar.calculate_azi_elev([epoch], LATITUDE, LONGITUDE)
+    return float(azi[0]), float(elev[0])
 
-def plot_pv(azi_elev_pv, filename):
+def plot_pv(azi_elev_pv, filename):    # azi_elev_pv is an (N,3) array
     print("plot_pv",filename)
-    azi = np.array([t[0] for t in azi_elev_pv])
-    elev = np.array([t[1] for t in azi_elev_pv])
-    pv = np.array([t[2] for t in azi_elev_pv])
+    azi = azi_elev_pv[:,0]
+    elev = azi_elev_pv[:,1]
+    pv = azi_elev_pv[:,2]
 
     xi = np.linspace(azi.min(), azi.max(), 512)
     yi = np.linspace(elev.min(), elev.max(), 512)
@@ -386,15 +539,13 @@ def plot_pv(azi_elev_pv, filename):
     plt.title('Battery import/export by azimuth & elevation')
     plt.savefig(plots_dir + "azi_elev_pv_"+filename, dpi=300)
 
-if __name__ == "__main__":
-    print("Using date range",earliest_date,"to",latest_date)
-    print("Which is HH",earliest_hh,"to",latest_hh)
-    kWh_used_by_hh, azi_elev_pv = get_readings()
-    plot_pv(azi_elev_pv, "azi_elev_pv")
-    daily_kWh_profile = daily_profile(kWh_used_by_hh)
-    print(daily_kWh_profile)
-    price_by_hh = get_prices()
+def set_battery_size(battery_kW, battery_kWh):
+    global BATTERY_KW, BATTERY_KWH, BATT_KWH_PER_HH
+    BATTERY_KW = battery_kW
+    BATTERY_KWH = battery_kWh
+    BATT_KWH_PER_HH = BATTERY_KW / 2
 
+def run_year(kWh_used_by_hh, price_by_hh, daily_kWh_profile, verbose=True):
     total_cost = 0
     total_savings = 0
     batt_kWh = 0
@@ -402,10 +553,77 @@ if __name__ == "__main__":
         prices = select_48_hhs(hh, price_by_hh)
         actual_kWh = select_48_hhs(hh, kWh_used_by_hh)
         day = int((hh-earliest_hh)/48)
-        cost, savings, batt_kWh = plan_do_one_thing(day,batt_kWh, daily_kWh_profile, actual_kWh, prices)
-        print("Day",(hh-earliest_hh)/48,"cost",cost,"savings",savings,"batt_kWh",batt_kWh)
+        cost, savings, batt_kWh = plan_optimally(day,batt_kWh, daily_kWh_profile, actual_kWh, prices)
+        if verbose:
+            print("Day",(hh-earliest_hh)/48,"cost",cost,"savings",savings,"batt_kWh",batt_kWh)
         total_cost += cost
         total_savings += savings
+    return total_cost, total_savings
+
+sweep_data = None   # Each sweep worker's copy of the readings & prices (inherited rather than reloaded)
+
+def init_sweep_worker(data):
+    global sweep_data, OUTPUT_PLOTS
+    sweep_data = data
+    OUTPUT_PLOTS = False    # Plot numbering isn't shared between processes, and we don't want a year of plots per size anyway
+
+def sweep_one(size):
+    set_battery_size(*size)
+    total_cost, total_savings = run_year(*sweep_data, verbose=False)
+    return size, total_cost, total_savings
+
+def sweep(kWh_used_by_hh, price_by_hh, daily_kWh_profile):
+    # Run the year for every combination of inverter kW and battery kWh, one size per process, and report savings as a table & heatmap
+    sizes = [(kW, kWh) for kW in SWEEP_INVERTER_KW for kWh in SWEEP_BATTERY_KWH]
+    print("Sweeping",len(sizes),"sizes across",multiprocessing.cpu_count(),"cores")
+    savings = np.zeros((len(SWEEP_INVERTER_KW), len(SWEEP_BATTERY_KWH)))
+    with multiprocessing.Pool(initializer=init_sweep_worker, initargs=((kWh_used_by_hh, price_by_hh, daily_kWh_profile),)) as pool:
+        for (kW, kWh), total_cost, total_savings in pool.imap_unordered(sweep_one, sizes):
+            print("inverter kW",kW,"batt kWh",kWh,"total cost",int(total_cost),"total savings",int(total_savings))
+            savings[SWEEP_INVERTER_KW.index(kW), SWEEP_BATTERY_KWH.index(kWh)] = total_savings / 100  # GBP
+
+    print("Savings GBP/year. Rows are inverter kW, columns are battery kWh")
+    print("kW \\ kWh " + "".join(["%8s" % kWh for kWh in SWEEP_BATTERY_KWH]))
+    for row, kW in enumerate(SWEEP_INVERTER_KW):
+        print("%9s " % kW + "".join(["%8.0f" % v for v in savings[row]]))
+
+    plt.figure(figsize=(8, 6))
+    plt.imshow(savings, origin='lower', cmap='viridis', aspect='auto')
+    plt.colorbar(label='Savings GBP/year')
+    plt.xticks(range(len(SWEEP_BATTERY_KWH)), SWEEP_BATTERY_KWH)
+    plt.yticks(range(len(SWEEP_INVERTER_KW)), SWEEP_INVERTER_KW)
+    for row in range(len(SWEEP_INVERTER_KW)):
+        for col in range(len(SWEEP_BATTERY_KWH)):
+            plt.text(col, row, "%.0f" % savings[row, col], ha='center', va='center', fontsize=6, color='white')
+    plt.xlabel('Battery kWh')
+    plt.ylabel('Inverter kW')
+    plt.title('Annual savings by battery & inverter size')
+    plt.savefig(plots_dir + "sweep_heatmap", dpi=300)
+    plt.close()
+    return savings
+
+if __name__ == "__main__":
+    print("Using date range",earliest_date,"to",latest_date)
+    print("Which is HH",earliest_hh,"to",latest_hh)
+    kWh_used_by_hh, azi_elev_pv = get_readings()
+    plot_pv(azi_elev_pv, "azi_elev_pv")
+    daily_kWh_profile = daily_profile(kWh_used_by_hh)
+    print(daily_kWh_profile)
+    price_by_hh = get_prices()
+
+    if (len(sys.argv) > 1) and (sys.argv[1] == "sweep"):   # python fcast.py sweep
+        sweep(kWh_used_by_hh, price_by_hh, daily_kWh_profile)
+        sys.exit()
+
+    if (len(sys.argv) > 1) and (sys.argv[1] == "robust"):  # python fcast.py robust
+        run_robust_year(kWh_used_by_hh, price_by_hh, daily_kWh_profile)
+        sys.exit()
+
+    if (len(sys.argv) > 1) and (sys.argv[1] == "rolling"): # python fcast.py rolling
+        run_scenario(0, kWh_used_by_hh, price_by_hh, daily_kWh_profile)
+        sys.exit()
+
+    total_cost, total_savings = run_year(kWh_used_by_hh, price_by_hh, daily_kWh_profile)
 
     if OUTPUT_PLOTS:
         save_movie()
@@ -1,26 +1,274 @@
 # A reading file stores up to 1 day of data
 # We store as we go, so if we get interrupted we don't lose today's history
 # We can also store weather files in the same way
+#
+# Rather than rewrite a whole day's file every time a reading arrives, readings are appended to a per-day journal (one compact JSON line per
+# record), which is compacted into the day's file once the day is over. read_file() merges any journal in, so callers needn't know.
+# Reading history (e.g. for the month view) happens a lot, so read_file() keeps the most recently read files in memory, checking each time
+# that the file on disk hasn't changed. Callers mustn't modify what they're given - copy it first.
+# Whole files are written atomically (write a temporary file, then rename) so a power cut never leaves a half-written file.
+# Files for days more than COMPRESS_AFTER_DAYS ago are gzipped by compress_cold(), with any settings they contain replaced by a reference
+# (a hash) into one shared table, since the settings rarely change. read_file() and file_exists() handle either form.
+# A compressed file starts with a line recording the signature of the file it came from, so that compressing a file doesn't change
+# its signature (which is how e.g. ml and archive tell whether a day has changed).
+#
+# python filer.py measure       Show the size of our history, and the time taken to read it, in each form
 
 import os
+import sys
 from pathlib import Path
 import json
+import time
+import gzip
+import hashlib
+import datetime
+from collections import OrderedDict
 
 FILE_PATH = "../bc_data/"
 FILE_SUFFIX = ".json"
+JOURNAL_SUFFIX = ".journal"
+COMPRESSED_SUFFIX = ".json.gz"
+SETTINGS_TABLE_FILE = FILE_PATH + "settings_table.json"
+COMPRESS_AFTER_DAYS = 30
+JOURNAL_FSYNC_S = 60    # Flush journals to disk at most this often (each record is always handed to the OS straight away)
+
+READ_CACHE_FILES = 100 # How many files' contents read_file() keeps
+
+JOURNALS = {}   # Open journal files, by path, with when each was last fsync'd
+READ_CACHE = OrderedDict()  # (prefix, name) : (signature, data), least recently used first
+SETTINGS_TABLE = None       # Hash : settings
+SOURCE_SIGNATURES = {}      # Compressed file path : (its own signature, signature of the file it came from)
+CACHE_HITS = 0
+CACHE_MISSES = 0
 
 os.chdir(os.path.dirname(__file__)) # Change directory to whereever this file is (e.g. if we're run from init script)
 
+def file_path(prefix, name):
+    return FILE_PATH + prefix + "_" + name + FILE_SUFFIX
+
+def journal_path(prefix, name):
+    return FILE_PATH + prefix + "_" + name + JOURNAL_SUFFIX
+
+def compressed_path(prefix, name):
+    return FILE_PATH + prefix + "_" + name + COMPRESSED_SUFFIX
+
 def file_exists(prefix, name):
-    p = FILE_PATH + prefix + "_" + name + FILE_SUFFIX
-    return os.path.exists(p)
-    
+    return os.path.exists(file_path(prefix, name)) or os.path.exists(journal_path(prefix, name)) or os.path.exists(compressed_path(prefix, name))
+
+def list_names(prefix):
+    # Names (e.g. dates) of all the files with this prefix, in order
+    names = set()
+    for f in os.listdir(FILE_PATH) if os.path.exists(FILE_PATH) else []:
+        if f.startswith(prefix + "_"):
+            for suffix in [COMPRESSED_SUFFIX, FILE_SUFFIX, JOURNAL_SUFFIX]:   # Longest first, as ".json" is also the end of ".json.gz"
+                if f.endswith(suffix):
+                    names.add(f[len(prefix)+1 : -len(suffix)])
+                    break
+    return sorted(names)
+
+def read_journal(p):
+    # Returns the records in a journal. A power cut may have left the last line incomplete, in which case we ignore it.
+    records = []
+    for line in open(p,"rt"):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            print("Ignoring incomplete line in",p)
+    return records
+
+def settings_table(reload=False):
+    global SETTINGS_TABLE
+    if (SETTINGS_TABLE is None) or reload:
+        SETTINGS_TABLE = {}
+        if os.path.exists(SETTINGS_TABLE_FILE):
+            SETTINGS_TABLE = json.loads(open(SETTINGS_TABLE_FILE,"rt").read())
+    return SETTINGS_TABLE
+
+def settings_hash(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[0:16]
+
+def stat_signature(p):
+    try:
+        st = os.stat(p)
+        return [st.st_mtime_ns, st.st_size]
+    except FileNotFoundError:
+        return None
+
+def read_compressed(p):
+    f = gzip.open(p,"rt")
+    data = json.loads(f.readline())
+    if "source_signature" in data:  # Files compressed before we recorded this are just the data
+        data = json.loads(f.read())
+    if "settings_hash" in data:
+        h = data.pop("settings_hash")
+        if h not in settings_table():
+            settings_table(reload=True)     # Another process (e.g. main's rollover) may have added to the table since we loaded it
+        data["settings"] = settings_table()[h]
+    return data
+
+def source_signature(p):
+    # The signature of the file that a compressed file was made from
+    sig = stat_signature(p)
+    if (p not in SOURCE_SIGNATURES) or (SOURCE_SIGNATURES[p][0] != sig):
+        header = json.loads(gzip.open(p,"rt").readline())
+        SOURCE_SIGNATURES[p] = (sig, header.get("source_signature", sig))
+    return SOURCE_SIGNATURES[p][1]
+
+def _read_file(prefix, name):
+    p = file_path(prefix, name)
+    if os.path.exists(p):
+        data = json.loads(open(p,"rt").read())
+    elif os.path.exists(compressed_path(prefix, name)):
+        data = read_compressed(compressed_path(prefix, name))
+    elif os.path.exists(journal_path(prefix, name)):
+        data = { "readings" : [] }  # Only a journal so far, e.g. today
+    else:
+        raise FileNotFoundError("No such file: " + p)
+    j = journal_path(prefix, name)
+    if os.path.exists(j):
+        for record in read_journal(j):
+            if "reading_number" in record:  # Later records for the same reading replace earlier ones
+                n = record["reading_number"]
+                data["readings"].extend([{}] * (n + 1 - len(data["readings"])))
+                data["readings"][n] = record
+            else:
+                data.update(record)         # e.g. settings
+    return data
+
+def signature(prefix, name):
+    # Changes if the file or its journal change, but not if the file gets compressed
+    sig = stat_signature(file_path(prefix, name))
+    if (sig is None) and os.path.exists(compressed_path(prefix, name)):
+        sig = source_signature(compressed_path(prefix, name))
+    return [sig, stat_signature(journal_path(prefix, name))]
+
 def read_file(prefix, name):
-    p = FILE_PATH + prefix + "_" + name + FILE_SUFFIX
-    return json.loads(open(p,"rt").read())
+    global CACHE_HITS, CACHE_MISSES
+    key = (prefix, name)
+    sig = signature(prefix, name)
+    if (key in READ_CACHE) and (READ_CACHE[key][0] == sig):
+        CACHE_HITS += 1
+        READ_CACHE.move_to_end(key)
+        return READ_CACHE[key][1]
+    CACHE_MISSES += 1
+    data = _read_file(prefix, name)
+    READ_CACHE[key] = (sig, data)
+    READ_CACHE.move_to_end(key)
+    while len(READ_CACHE) > READ_CACHE_FILES:
+        READ_CACHE.popitem(last=False)
+    return data
+
+def invalidate(prefix, name):
+    READ_CACHE.pop((prefix, name), None)
+
+def cache_stats():
+    return { "hits" : CACHE_HITS, "misses" : CACHE_MISSES, "files" : len(READ_CACHE) }
+
+def replace_file(p, content):
+    # Write bytes to a temporary file, make sure they're on disk, then rename it over p, so p is always either the old or the new contents
+    with open(p + ".tmp","wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(p + ".tmp", p)
 
 def write_file(prefix, name, data):
     Path(FILE_PATH).mkdir(parents=True, exist_ok=True)
-    p = FILE_PATH + prefix + "_" + name + FILE_SUFFIX
-    open(p,"wt").write(json.dumps(data))
+    invalidate(prefix, name)
+    replace_file(file_path(prefix, name), json.dumps(data).encode())
+
+def append_journal(prefix, name, record, header=None):
+    # Append one record (e.g. a reading, with its "reading_number") to the day's journal. header (e.g. settings) is written first, if the journal is new.
+    Path(FILE_PATH).mkdir(parents=True, exist_ok=True)
+    invalidate(prefix, name)
+    p = journal_path(prefix, name)
+    if p not in JOURNALS:
+        new = not os.path.exists(p)
+        torn = (not new) and (os.path.getsize(p) > 0) and (open(p,"rb").read()[-1:] != b"\n")
+        JOURNALS[p] = { "file" : open(p,"at"), "synced" : 0 }
+        if torn:
+            JOURNALS[p]["file"].write("\n")   # Keep a new record clear of an incomplete last line
+        if new and (header is not None):
+            JOURNALS[p]["file"].write(json.dumps(header, separators=(",",":")) + "\n")
+    journal = JOURNALS[p]
+    journal["file"].write(json.dumps(record, separators=(",",":")) + "\n")
+    journal["file"].flush()
+    if time.time() - journal["synced"] >= JOURNAL_FSYNC_S:
+        os.fsync(journal["file"].fileno())
+        journal["synced"] = time.time()
+
+def close_journal(p):
+    if p in JOURNALS:
+        JOURNALS[p]["file"].close()
+        del JOURNALS[p]
+
+def compact(prefix, name):
+    # Fold a day's journal into its file. If interrupted, the journal is still there and merges in the same way next time.
+    j = journal_path(prefix, name)
+    if not os.path.exists(j):
+        return
+    close_journal(j)
+    write_file(prefix, name, _read_file(prefix, name))
+    os.remove(j)
+    invalidate(prefix, name)
+    print("Compacted",j)
+
+def compact_journals(prefix, except_name=None):
+    # Compact any journals left over (e.g. if we weren't running at rollover)
+    for f in sorted(os.listdir(FILE_PATH)) if os.path.exists(FILE_PATH) else []:
+        if f.startswith(prefix + "_") and f.endswith(JOURNAL_SUFFIX):
+            name = f[len(prefix)+1 : -len(JOURNAL_SUFFIX)]
+            if name != except_name:
+                compact(prefix, name)
+
+def compress(prefix, name):
+    # Replace a file by its compressed form
+    source = stat_signature(file_path(prefix, name))    # Before reading, as in archive.update()
+    data = json.loads(open(file_path(prefix, name),"rt").read())
+    if "settings" in data:
+        h = settings_hash(data["settings"])
+        if h not in settings_table():
+            settings_table()[h] = data["settings"]
+            replace_file(SETTINGS_TABLE_FILE, json.dumps(settings_table()).encode())  # Before the file that refers to it
+        data = { k : v for (k,v) in data.items() if k != "settings" }
+        data["settings_hash"] = h
+    replace_file(compressed_path(prefix, name), gzip.compress((json.dumps({ "source_signature" : source }) + "\n" + json.dumps(data)).encode()))
+    os.remove(file_path(prefix, name))  # Only once the compressed file is safely on disk. If we're interrupted before this, the uncompressed file is still the one read, and we'll try again next time
+    invalidate(prefix, name)
+
+def compress_cold(prefix, days=COMPRESS_AFTER_DAYS):
+    # Compress any files (named by date) older than the given number of days. Returns how many.
+    cutoff = (datetime.datetime.utcnow().date() - datetime.timedelta(days=days)).isoformat()
+    count = 0
+    for name in list_names(prefix):
+        if (name < cutoff) and os.path.exists(file_path(prefix, name)) and not os.path.exists(journal_path(prefix, name)):
+            compress(prefix, name)
+            count += 1
+    if count > 0:
+        print("Compressed",count,prefix,"files")
+    return count
+
+def measure():
+    # For each type of file, in each form: how many there are, how many bytes a full scan reads, and how long each takes to decode
+    for prefix in ["readings", "weather"]:
+        names = list_names(prefix)
+        for (form, path_fn, read_fn) in [("json", file_path, lambda p: json.loads(open(p,"rt").read())), ("json.gz", compressed_path, read_compressed)]:
+            paths = [path_fn(prefix, name) for name in names if os.path.exists(path_fn(prefix, name))]
+            if len(paths) == 0:
+                continue
+            size = sum([os.path.getsize(p) for p in paths])
+            t1 = time.time()
+            for p in paths:
+                read_fn(p)
+            t = time.time() - t1
+            print("%-8s %-7s %5d files, %10d bytes (%7d per file), %6.2fms to decode each, %6.2fs for all" % (prefix, form, len(paths), size, size / len(paths), 1000 * t / len(paths), t))
+    if os.path.exists(SETTINGS_TABLE_FILE):
+        print("Settings table", len(settings_table()), "entries,", os.path.getsize(SETTINGS_TABLE_FILE), "bytes")
 
+if __name__ == "__main__":
+    if (len(sys.argv) > 1) and (sys.argv[1] == "measure"):
+        measure()
+    if (len(sys.argv) > 1) and (sys.argv[1] == "compress"):    # python filer.py compress [days]
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else COMPRESS_AFTER_DAYS
+        compress_cold("readings", days)
+        compress_cold("weather", days)
@@ -0,0 +1,99 @@
+# A time series with one value per half-hour, held as a NumPy array plus a mask saying which half-hours actually have data
+# Half-hours are absolute (epoch-time divided by half an hour), and the series covers first_hh up to (but not including) first_hh+length
+
+import numpy as np
+
+HHS_PER_DAY = 48
+
+class HalfHourSeries:
+    def __init__(self, first_hh, length):
+        self.first_hh = first_hh
+        self.values = np.zeros(length)
+        self.valid = np.zeros(length, dtype=bool)
+
+    def __len__(self):
+        return len(self.values)
+
+    def end_hh(self):
+        return self.first_hh + len(self.values)
+
+    def _offsets(self, hhs):
+        # Returns offsets into our arrays for the given half-hours, and a mask of which of them are within our range
+        offsets = np.asarray(hhs, dtype=np.int64) - self.first_hh
+        in_range = (offsets >= 0) & (offsets < len(self.values))
+        return offsets, in_range
+
+    def add(self, hhs, values):
+        # Accumulate values into their half-hours (several values may land in the same half-hour). Returns how many were outside our range.
+        offsets, in_range = self._offsets(hhs)
+        np.add.at(self.values, offsets[in_range], np.asarray(values, dtype=float)[in_range])
+        self.valid[offsets[in_range]] = True
+        return int((~in_range).sum())
+
+    def set(self, hhs, values):
+        # Store values in their half-hours. Returns how many were outside our range, and how many half-hours were set more than once (last one wins).
+        offsets, in_range = self._offsets(hhs)
+        offsets = offsets[in_range]
+        duplicates = len(offsets) - len(np.unique(offsets)) + int(self.valid[offsets].sum())
+        self.values[offsets] = np.asarray(values, dtype=float)[in_range]
+        self.valid[offsets] = True
+        return int((~in_range).sum()), duplicates
+
+    def get(self, hh):
+        # Value at a single half-hour, or None if we have no data for it
+        offset = hh - self.first_hh
+        if (offset < 0) or (offset >= len(self.values)) or not self.valid[offset]:
+            return None
+        return float(self.values[offset])
+
+    def day(self, start_hh, length=HHS_PER_DAY):
+        # The values for length half-hours from start_hh, with missing data (or data outside our range) replaced by 0
+        result = np.zeros(length)
+        first = max(start_hh, self.first_hh)
+        end = min(start_hh + length, self.end_hh())
+        if end > first:
+            src = slice(first - self.first_hh, end - self.first_hh)
+            result[first-start_hh : end-start_hh] = np.where(self.valid[src], self.values[src], 0)
+        return result
+
+    def by_day(self):
+        # Returns (values, valid) reshaped to (days, 48), starting at first_hh. A partial last day is padded out with invalid half-hours.
+        days = -(-len(self.values) // HHS_PER_DAY)
+        values = np.zeros(days * HHS_PER_DAY)
+        valid = np.zeros(days * HHS_PER_DAY, dtype=bool)
+        values[:len(self.values)] = self.values
+        valid[:len(self.valid)] = self.valid
+        return values.reshape(days, HHS_PER_DAY), valid.reshape(days, HHS_PER_DAY)
+
+    def daily_profile(self):
+        # Average value for each of the 48 half-hours of the day, ignoring missing data
+        values, valid = self.by_day()
+        return np.where(valid, values, 0).sum(axis=0) / valid.sum(axis=0)
+
+    def total(self):
+        return float(self.values[self.valid].sum())
+
+    def mean(self):
+        return float(self.values[self.valid].mean())
+
+    def missing(self):
+        return int((~self.valid).sum())
+
+    def join(self, other):
+        # Returns (ours, theirs) covering just the half-hours which both series span, each only valid where both have data
+        first = max(self.first_hh, other.first_hh)
+        end = min(self.end_hh(), other.end_hh())
+        ours = self.slice(first, end)
+        theirs = other.slice(first, end)
+        both = ours.valid & theirs.valid
+        ours.valid = both
+        theirs.valid = both.copy()
+        return ours, theirs
+
+    def slice(self, first_hh, end_hh):
+        # A copy of the half-hours first_hh..end_hh-1, which must lie within our range
+        result = HalfHourSeries(first_hh, max(0, end_hh - first_hh))
+        src = slice(first_hh - self.first_hh, end_hh - self.first_hh)
+        result.values[:] = self.values[src]
+        result.valid[:] = self.valid[src]
+        return result
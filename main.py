@@ -17,16 +17,18 @@
 # So either we could use instantaneous Power readings instead of Energy odometers (still not completely accurate, as it means we're point-sampling)
 # Or we could integrate over longer periods.
 
-import sys, os, pygame, time, datetime, glob
+import sys, os, pygame, time, datetime
 import urllib.request, json, math
 import traceback
 from pygame.locals import *
 import pprint
 
-import sofar, utcstuff, weather, filer, utils, config, icons, ml
+import sofar, utcstuff, weather, filer, utils, config, icons, ml, summary
 
 WEATHER_UPDATE_INTERVAL_S = 60 * 30
 SOFAR_UPDATE_INTERVAL_S = 1             # How often we read and display fast-changing numbers like power
+SOFAR_STALE_S = 10                      # Show inverter data as stale if the latest snapshot is older than this
+SOFAR_FIRST_WAIT_S = 15                 # At startup, wait no longer than this for inverter data
 READINGS_INTERVAL_S = 60*5              # How often we transfer accumulated, slow-changing numbers like kWh
 READINGS_PER_DAY = int((60*60*24)/READINGS_INTERVAL_S)
 BINS_PER_DAY = 8    # For forecasting and ML etc.
@@ -65,12 +67,14 @@ HOUSE_CHEAP_COLOUR = LIGHT_RED
 BATTERY_COLOUR = BLUE
 IMPORT_COLOUR = GREY
 PREDICTION_COLOUR = MAGENTA
+STALE_PREDICTION_COLOUR = GREY
 
 BUTTON_FOREGROUND = WHITE
 BUTTON_BACKGROUND = DARK_BLUE
 BUTTON_SELECTED = LIGHT_BLUE
 
 BUTTONS = {}
+SNAPSHOT = None # Latest inverter values, from the sofar poller
 
 fonts = {}
 
@@ -210,7 +214,7 @@ def draw_time_and_cursor():
     draw_text(tstr, SCREEN_WIDTH,0,WHITE,BACKGROUND, align="right")
 
 def get_inverter_values_and_update_odometers():
-    global ODOMETERS
+    global ODOMETERS, SNAPSHOT
     def do_delta(name, allow_negative=False):
         if name not in values or name not in prev_values:
             return(0)
@@ -220,9 +224,13 @@ def get_inverter_values_and_update_odometers():
             diff = 0
         return diff
 
-    # Get data
-    prev_values = sofar.prev_values().copy()
-    values = sofar.read_sofar()
+    # Get data. This never waits for the inverter - the poller thread does that.
+    prev = SNAPSHOT
+    SNAPSHOT = sofar.snapshot()
+    if (prev is None) or (SNAPSHOT is prev):
+        return
+    prev_values = prev.values
+    values = SNAPSHOT.values
 
     # Update odometers
     ODOMETERS["pv"] += do_delta("Daily Generation")
@@ -230,38 +238,46 @@ def get_inverter_values_and_update_odometers():
     ODOMETERS["export"] += do_delta("Daily Export")
     ODOMETERS["import"] += do_delta("Daily Import")
     ODOMETERS["batt%change"] += do_delta("Battery Charge Level", True)
-    ODOMETERS["batt charge"] += values["Battery Charge kWh"]["value"]
-    ODOMETERS["batt discharge"] += values["Battery Discharge kWh"]["value"]
+    ODOMETERS["batt charge"] += SNAPSHOT.battery_charge_kWh - prev.battery_charge_kWh
+    ODOMETERS["batt discharge"] += SNAPSHOT.battery_discharge_kWh - prev.battery_discharge_kWh
 
 def draw_instants(readings):
-    (off_peak, on_peak, totals) = totals_for_day(readings)
-    values = sofar.prev_values()
+    def instant(name, field="value"):
+        if (SNAPSHOT is None) or (name not in SNAPSHOT.values):
+            return "-"
+        return str(SNAPSHOT.values[name][field])
+
+    (off_peak, on_peak, totals) = summary.totals_for_day(readings)
     x = int(LEFT_MARGIN + 2*(SCREEN_WIDTH-LEFT_MARGIN)/3 + 55)
     x2 = x + 95
     y = int(TITLE_HEIGHT + STRIPCHART_HEIGHT)
     draw_text("W",x,y-20,GREY,BACKGROUND,align="right", font_size=20)
     draw_text("kWh",x2,y-20,GREY,BACKGROUND,align="right", font_size=20)
+    if SNAPSHOT is None:
+        draw_text("no inverter data", x, y-30, GREY, BACKGROUND, align="right", font_size=10)
+    elif sofar.snapshot_age(SNAPSHOT) > SOFAR_STALE_S:
+        draw_text("inverter data %ds old" % sofar.snapshot_age(SNAPSHOT), x, y-30, GREY, BACKGROUND, align="right", font_size=10)
 
-    draw_text(str(values["PV Power"]["value"]), x, y, PV_COLOUR, BACKGROUND, align="right", font_size=20) 
+    draw_text(instant("PV Power"), x, y, PV_COLOUR, BACKGROUND, align="right", font_size=20) 
     if "pv" in totals:
         draw_text("%2.1f" % totals["pv"], x2, y, PV_COLOUR, BACKGROUND, align="right", font_size=20)
     if ml.PV_PREDICTION is not None:
-        draw_text("predict %2.1f" % sum(ml.PV_PREDICTION), x2, y+16, PV_COLOUR, BACKGROUND, align="right", font_size=10)
+        draw_text(("predict %2.1f" % sum(ml.PV_PREDICTION)) + [""," (stale)"][ml.PREDICTION_STALE], x2, y+16, PV_COLOUR, BACKGROUND, align="right", font_size=10)
 
     y += STRIPCHART_HEIGHT
-    draw_text(str(values["House Consumption"]["value"]), x, y, HOUSE_COLOUR, BACKGROUND, align="right", font_size=20) 
+    draw_text(instant("House Consumption"), x, y, HOUSE_COLOUR, BACKGROUND, align="right", font_size=20) 
     if ("house" in off_peak) and ("house" in on_peak):
         draw_text("%2.1f+%2.1f" % (off_peak["house"], on_peak["house"]), x2, y, HOUSE_COLOUR, BACKGROUND, align="right", font_size=20)
     if ml.CONSUMPTION_ON_PEAK_PREDICTION is not None:
-        draw_text("predict %2.1f" % sum(ml.CONSUMPTION_ON_PEAK_PREDICTION), x2, y+16, HOUSE_COLOUR, BACKGROUND, align="right", font_size=10)
+        draw_text(("predict %2.1f" % sum(ml.CONSUMPTION_ON_PEAK_PREDICTION)) + [""," (stale)"][ml.PREDICTION_STALE], x2, y+16, HOUSE_COLOUR, BACKGROUND, align="right", font_size=10)
 
     y += STRIPCHART_HEIGHT
-    v = str(values["Battery Charge Power"]["value"])
-    draw_text(v, x, y, [GREEN,RED][v[0]=="-"], BACKGROUND, align="right", font_size=20)
-    draw_text(values["Battery Charge Level"]["text"], x2, y, BATTERY_COLOUR, BACKGROUND, align="right", font_size=20)
+    v = instant("Battery Charge Power")
+    draw_text(v, x, y, [GREEN,RED][v[0]=="-" and len(v) > 1], BACKGROUND, align="right", font_size=20)
+    draw_text(instant("Battery Charge Level", "text"), x2, y, BATTERY_COLOUR, BACKGROUND, align="right", font_size=20)
 
     y += STRIPCHART_HEIGHT
-    draw_text(str(values["Grid Power"]["value"]), x, y, WHITE, BACKGROUND, align="right", font_size=20)
+    draw_text(instant("Grid Power"), x, y, WHITE, BACKGROUND, align="right", font_size=20)
 
     x = 340
     y += 20
@@ -328,13 +344,6 @@ def make_list_or_zeroes(the_set, the_keys):
             L.append(0)
     return L
 
-def sum_by_key(list_of_sets, the_key):
-    total = 0.0
-    for s in list_of_sets:
-        if the_key in s:
-            total += float(s[the_key])
-    return total
-
 def draw_historic():
     y_scale = 20
 
@@ -346,22 +355,21 @@ def draw_historic():
     # Draw last 30 days
     DAYS = 30
     scalar = (SCREEN_WIDTH - LEFT_MARGIN) / DAYS
+    days = summary.days_between(utcstuff.date_days_relative_to_today_iso8601(-DAYS), utcstuff.date_days_relative_to_today_iso8601(-1))
     for d in range(DAYS):
         date = utcstuff.date_days_relative_to_today_iso8601(-DAYS+d)
         x = int(LEFT_MARGIN + d * scalar)
-        if filer.file_exists("readings", date):
-            readings = filer.read_file("readings", date)["readings"]
-            (off_peak, on_peak, totals) = totals_for_day(readings)
-            values = make_list_or_zeroes(totals, ["import cost at expensive", "import cost at cheap", "import savings", "pv savings", "house pv"])
+        record = days.get(date, {})
+        if "totals" in record:
+            values = make_list_or_zeroes(record["totals"], ["import cost at expensive", "import cost at cheap", "import savings", "pv savings", "house pv"])
             values = values[0:4] + [values[4] * config.setting("unit_cost_expensive")]    # House PV kWh -> £
             draw_stack(LEFT_MARGIN + d*scalar, scalar,
                 values,
                 [GREY, LIGHT_GREY, BLUE, WHITE, YELLOW],
                 y_scale)
 
-        if filer.file_exists("weather", date):
-            weather = filer.read_file("weather", date)["raw"]
-            height = int(sum_by_key(weather,"U") * 3)
+        if "uv" in record:
+            height = int(record["uv"] * 3)
             pygame.draw.rect(SCREEN, UV_COLOUR, Rect(x,int(STRIPCHART_HEIGHT-height),int(scalar)+1,height))
             
         pygame.draw.line(SCREEN, DARK_GREY, (x,0), (x, SCREEN_HEIGHT))
@@ -370,7 +378,8 @@ def transfer_odometers(readings):
     now = time.time()
     reading_number = int((now - utcstuff.start_of_today_epoch_s()) / READINGS_INTERVAL_S)
     readings[reading_number] = ODOMETERS.copy()
-    readings[reading_number].update({"battery %" : sofar.prev_values()["Battery Charge Level"]["value"]})   # Instantaneous value at the end of the period, not odometer reading 
+    if SNAPSHOT is not None:
+        readings[reading_number].update({"battery %" : SNAPSHOT.values["Battery Charge Level"]["value"]})   # Instantaneous value at the end of the period, not odometer reading 
     readings[reading_number].update({"reading_number" : reading_number, "end" : int(time.time()) })
     pv, house = readings[reading_number]["pv"], readings[reading_number]["house"]
     readings[reading_number].update({"house pv" :  min(pv,house) })
@@ -394,28 +403,9 @@ def transfer_odometers(readings):
         "import savings" : import_savings})
 
     print("Reading_number",reading_number,"is",readings[reading_number])
-    filer.write_file("readings", utcstuff.todays_date_iso8601(), {"settings" : config.settings(), "readings" : readings})
+    filer.append_journal("readings", utcstuff.todays_date_iso8601(), readings[reading_number], header={"settings" : config.settings()})
     reset_odometers()
 
-def totals_for_day(readings):
-    def set_or_add(mydict, mykey, myvalue):
-        if mykey not in mydict:
-            mydict[mykey] = myvalue
-        else:
-            mydict[mykey] += myvalue
-    off_peak = {}
-    on_peak = {}
-    totals = {} # Totals is off-peak PLUS on-peak
-    for r in readings:
-        for (k,v) in r.items():
-            set_or_add(totals, k, v)
-            if r["cheap_rate"]:
-                set_or_add(off_peak, k, v)
-            else:
-                set_or_add(on_peak, k, v)
-
-    return (off_peak, on_peak, totals)
-
 def draw_readings(readings_yesterday, readings):
     wid = SCREEN_WIDTH - LEFT_MARGIN
     def draw_seg(data, i, x, y, quantum, name, max_value, colour):
@@ -446,6 +436,7 @@ def draw_readings(readings_yesterday, readings):
     pygame.draw.line(SCREEN, BATTERY_COLOUR, (LEFT_MARGIN, y_minbatt), (LEFT_MARGIN + int((SCREEN_WIDTH-LEFT_MARGIN) * 2.0/3), y_minbatt))
 
 def draw_predictions(readings):
+    colour = [PREDICTION_COLOUR, STALE_PREDICTION_COLOUR][ml.PREDICTION_STALE]
     def draw_prediction(stripchart_number, bins, limit):
         wid = SCREEN_WIDTH - LEFT_MARGIN
         x_scalar = (wid / 3) / float(BINS_PER_DAY)
@@ -458,9 +449,9 @@ def draw_predictions(readings):
                 x = int(LEFT_MARGIN + (pane * BINS_PER_DAY + bin) * x_scalar)
                 y = int(((stripchart_number+1) * STRIPCHART_HEIGHT) - bins[bin] * y_scalar)
                 if last_x is not None:
-                    pygame.draw.line(SCREEN, PREDICTION_COLOUR, (last_x, last_y), (x, y))   # Vertical step from last reading
+                    pygame.draw.line(SCREEN, colour, (last_x, last_y), (x, y))   # Vertical step from last reading
                 new_x = int(x + x_scalar)
-                pygame.draw.line(SCREEN, PREDICTION_COLOUR, (x,y), (new_x,y))          # Horizontal line for this reading
+                pygame.draw.line(SCREEN, colour, (x,y), (new_x,y))          # Horizontal line for this reading
                 last_x = new_x
                 last_y = y
 
@@ -503,34 +494,11 @@ def get_weather_forecast_and_predict_PV(three_hourly_weather):
     filer.write_file("weather", utcstuff.todays_date_iso8601(),     { "raw" : raw[0:8] } )
     filer.write_file("weather", utcstuff.tomorrows_date_iso8601(),  { "raw" : raw[8:16] } ) 
 
-    ml.learn_and_predict(three_hourly_weather[1])
+    ml.start_learn_and_predict(three_hourly_weather[1])    # Result is picked up by the main loop
 
 def predict_all_days():
-    # "prediction vs. reality" back-casting
-    files = sorted(list(glob.glob('../bc_data/weather*.json')))
-    print("Back-casted PV predictions on",len(files),"weather files")
-    for f in files:
-        basename = os.path.basename(f)
-        basename = basename.split("_")[1]
-        basename = basename.split(".")[0]
-        print(basename+" ",end="")
-        data = filer.read_file("weather", basename)
-        if "raw" not in data:  
-            print("Data missing, skipping")
-            continue
-        data = data["raw"]
-        if len(data) < 1:
-            print("Data too short, skipping")
-            continue
-        ok = True
-        for d in data:
-            if "W" not in d:
-                ok = False
-        if not ok:
-            print("Missing W data, skipping")
-            continue
-        prediction = ml.predict_only(data).sum()
-        print(prediction)
+    # "prediction vs. reality" back-casting. See ml.backcast()
+    ml.backcast()
 
 def status_screen(s):
     print(s)
@@ -572,19 +540,24 @@ def main():
         weather.choose_weather_station()
 
     status_screen("reading from inverter...")
-    sofar.read_sofar()  # Get sensible values into cache
+    sofar.start_poller()
+    if sofar.wait_for_snapshot(SOFAR_FIRST_WAIT_S) is None:    # Get sensible values to start from, but don't hang if the inverter isn't answering
+        print("No data from inverter yet, carrying on without it")
 
     status_screen("loading files...")
     yesterdays_date, todays_date, tomorrows_date = utcstuff.yesterdays_date_iso8601(), utcstuff.todays_date_iso8601(), utcstuff.tomorrows_date_iso8601()
+    filer.compact_journals("readings", except_name=todays_date)
     if filer.file_exists("readings", todays_date):
         print("Loading today's existing readings file")
         READINGS = filer.read_file("readings", todays_date)["readings"]
+        READINGS = READINGS + [{}] * (READINGS_PER_DAY - len(READINGS))  # Journal may only go up to the latest reading. Also makes a copy, since we modify it and filer caches what it returns.
     else:
         print("No readings file yet for today") 
 
     if filer.file_exists("readings", yesterdays_date):
         print("Loading yesterday's existing readings file")
         READINGS_YESTERDAY = filer.read_file("readings", yesterdays_date)["readings"]
+        READINGS_YESTERDAY = READINGS_YESTERDAY + [{}] * (READINGS_PER_DAY - len(READINGS_YESTERDAY))    # Compacted from a journal, so likewise may stop at its last reading
     else:
         print("No readings file for yesterday") 
     
@@ -598,8 +571,7 @@ def main():
         data2 = filer.read_file("weather", tomorrows_date)
         THREE_HOURLY_WEATHER[1] = data1["raw"]
         THREE_HOURLY_WEATHER[2] = data2["raw"]
-        status_screen("machine learning...")
-        ml.learn_and_predict(THREE_HOURLY_WEATHER[1])
+        ml.start_learn_and_predict(THREE_HOURLY_WEATHER[1])
     else:
         print("No saved weather forecast so getting a fresh forecast")
         get_weather_forecast_and_predict_PV(THREE_HOURLY_WEATHER)
@@ -616,6 +588,10 @@ def main():
 
     while(1):
         if current_utc_date != utcstuff.todays_date_iso8601():
+            filer.compact("readings", current_utc_date)
+            summary.update_day(current_utc_date)
+            filer.compress_cold("readings")
+            filer.compress_cold("weather")
             current_utc_date = utcstuff.todays_date_iso8601()
             print("New UTC day", current_utc_date)
             READINGS_YESTERDAY = READINGS.copy()
@@ -626,8 +602,12 @@ def main():
             get_weather_forecast_and_predict_PV(THREE_HOURLY_WEATHER)
             redraw = True
     
+        if ml.poll_prediction():
+            redraw = True
+
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                ml.stop_worker()
                 sys.exit()
             if event.type == pygame.MOUSEBUTTONDOWN:
                 print("MOUSEBUTTONDOWN")
@@ -4,107 +4,168 @@
 # Because weather is done in 3h bins, we bin the readings like that too
 # See https://machinelearningmastery.com/machine-learning-in-python-step-by-step/
 
-import json
 import os
 import sys, traceback, time
+import pickle
+import concurrent.futures
+import multiprocessing
+from pathlib import Path
 import numpy as np
+import tracemalloc
 from sklearn.neural_network import MLPRegressor
+from sklearn.linear_model import Ridge
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.pipeline import make_pipeline
+from sklearn.model_selection import TimeSeriesSplit
 import weather  # Just to map weather codes to icons (=categoricals)
+import consumption
+import archive
+import filer
 import utcstuff
 import config
 
-DIRECTORY = "../bc_data/"
+CACHE_DIR = "../bc_cache/"
+MODEL_FILE = CACHE_DIR + "ml_model.pkl"
+DATASET_FILE = CACHE_DIR + "ml_dataset.pkl"
+BENCHMARK_FOLDS = 5
+BENCHMARK_PREDICTS = 20 # Repeats when timing predictions
+PARTIAL_FIT_PASSES = 20 # How many times new days are shown to a saved model, rather than retraining it from scratch
+BACKCAST_FILE = CACHE_DIR + "backcast.csv"
 
 READING_PERIOD = 5 * 60
 READING_BINS_PER_3H = (3 * 60 * 60) / READING_PERIOD
 BINS_PER_DAY = 8    # 3H each
+NUM_FEATURES = 3 + weather.ONEHOT_TABLE.shape[1]   # Bin number, UV, temperature, then one-hot weather type
+DEFAULT_U = 0   # Used for any weather bin which is missing some fields
+DEFAULT_T = 20
+DEFAULT_W = 0
 
 # These arrays are all aligned by index. So WEATHER_FORECAST[N] matches READINGS_*[N]
-WEATHER_FORECAST = []
-READINGS_PV = []
-READINGS_HOUSE_ON_PEAK = []
+WEATHER_FORECAST = np.zeros((0, NUM_FEATURES))
+READINGS_PV = np.zeros(0)
+READINGS_HOUSE_ON_PEAK = np.zeros(0)
+
+DATASET = None  # Binned training data for each day, by date. See load_dataset()
 
 CLF = None
 PV_PREDICTION = None
 CONSUMPTION_ON_PEAK_PREDICTION = None
+PREDICTION_STALE = False    # True while newer predictions are being worked on in the background
 
-def read_readings(f, param, measure_off_and_on_peak = False):
-    # Returns a set of binned data, plus an error flag
-    readings = json.loads(open(f,"rt").read())["readings"]
-    bins = []
-    value = 0
-    errors = 0
-    for r in readings:
-        if not param in r:
-            errors += 1
-            continue
-        if measure_off_and_on_peak or (not r["cheap_rate"]):    # Only measure on-peak by default
-            value += r[param]
-        if r["reading_number"] % READING_BINS_PER_3H == READING_BINS_PER_3H-1:
-            bins.append(value)
-            value = 0
-    # print(f,len(bins), errors)
-    if len(bins) != BINS_PER_DAY:
+WORKER = None   # Process pool (of one) for start_learn_and_predict()
+PENDING = None  # Future for the most recent request
+
+def bin_slots(values, cheap_rate, measure_off_and_on_peak = False):
+    # Returns a day's archive slots (see archive.py) summed into 3h bins, plus an ok flag
+    values = np.asarray(values)
+    missing = np.isnan(values)
+    if missing[int(READING_BINS_PER_3H)-1::int(READING_BINS_PER_3H)].any():   # Each bin is closed by its last reading
         return (False, None)
-    if errors >= 3:  # Allow a small number of missed readings (about 1%)
+    if missing.sum() >= 3:  # Allow a small number of missed readings (about 1%)
         return (False, None)
-    return (True, bins)
+    if not measure_off_and_on_peak:
+        values = np.where(cheap_rate == 1, 0, values)   # Only measure on-peak by default
+    return (True, list(np.nansum(values.reshape(BINS_PER_DAY, -1), axis=1)))
+
+def weather_features(raw_days):
+    # Encode a list of days of raw Met Office bins into one (bins, NUM_FEATURES) array, all in one go
+    # We include bin number as a proxy for time of day, which is important since solar panels face in a particular direction
+    # UV & temperature are integers (i.e. on a continuous scale from a ML pov). Weather, though reported as an integer, is in fact a categorical, so encode as one-hot
+    bins = [r for raw in raw_days for r in raw]
+    complete = np.array([("U" in r) and ("T" in r) and ("W" in r) for r in bins], dtype=bool)
+    features = np.empty((len(bins), NUM_FEATURES))
+    features[:,0] = [b for raw in raw_days for b in range(len(raw))]
+    features[:,1] = [r["U"] if ok else DEFAULT_U for (r, ok) in zip(bins, complete)]
+    features[:,2] = [r["T"] if ok else DEFAULT_T for (r, ok) in zip(bins, complete)]
+    features[:,3:] = weather.codes_to_onehot([r["W"] if ok else DEFAULT_W for (r, ok) in zip(bins, complete)])
+    missing = len(bins) - int(complete.sum())
+    if missing > 0:
+        print("Missing U/T/W fields in",missing,"weather forecast data bins so using default values")
+    return features
 
 def relevant_weather_fields(raw):
-    wdata = []
-    for b in range(len(raw)):
-        # We include bin number as a proxy for time of day, which is important since solar panels face in a particular direction
-        r = raw[b]
-        if ("U" not in r) or ("T" not in r) or ("W" not in r):
-            print("Missing U/T/W fields in weather forecast data bin",b,"so using default values")
-            u = 0
-            t = 20
-            w = 0
-        else:
-            u = int(r["U"])
-            t = int(r["T"])
-            w = r["W"]
-        arr = [b, u, t]   # UV & temperature are integers (i.e. on a continuous scale from a ML pov)
-        arr.extend(weather.code_to_onehot(w)) # Weather, though reported as an integer, is in fact a categorical, so encode as one-hot
-        wdata.append(arr)
-    return wdata
+    return weather_features([raw])
 
 def read_weather(ymd_str):
-    f = DIRECTORY + "weather_" + ymd_str + ".json"
-    raw = json.loads(open(f,"rt").read())["raw"]
+    raw = filer.read_file("weather", ymd_str)["raw"]
     wdata = relevant_weather_fields(raw)
     if len(wdata) != BINS_PER_DAY:
         return (False, None)
     return (True, wdata)
 
+def load_day(ymd):
+    # Returns (ok, readings_pv, readings_house, wdata) for one day
+    cheap_rate = archive.day("cheap_rate", ymd)
+    (ok, readings_pv) = bin_slots(archive.day("pv", ymd), cheap_rate, measure_off_and_on_peak = True)
+    if not ok:
+        return (False, None, None, None)
+    (ok, readings_house) = bin_slots(archive.day("house", ymd), cheap_rate, measure_off_and_on_peak = False)    # Only measure on-peak
+    if not ok:
+        return (False, None, None, None)
+    (ok, wdata) = read_weather(ymd)
+    if not ok:
+        return (False, None, None, None)
+    return (True, readings_pv, readings_house, wdata)
+
+def training_days():
+    # Returns a dict of every day which has both a readings and a weather file, each with a fingerprint of those files (so we can tell if they change)
+    days = {}
+    weather_days = set(filer.list_names("weather"))
+    for ymd in filer.list_names("readings"):
+        if ymd in weather_days:
+            days[ymd] = [filer.signature("readings", ymd), filer.signature("weather", ymd)]
+    return days
+
+def load_dataset():
+    # Bring DATASET up to date with the files on disk, and return it.
+    # DATASET holds each day's binned features & targets as arrays, along with the fingerprint of the files they came from, and is kept on disk between runs.
+    # So only days whose files are new or have changed are re-read.
+    global DATASET
+    if DATASET is None:
+        DATASET = {}
+        if os.path.exists(DATASET_FILE):
+            try:
+                DATASET = pickle.loads(open(DATASET_FILE, "rb").read())
+            except Exception:
+                print("Could not load dataset cache, so will rebuild it")
+                traceback.print_exc(file=sys.stdout)
+    available = training_days()
+    if any((ymd not in DATASET) or (DATASET[ymd]["fingerprint"] != fingerprint) for (ymd, fingerprint) in available.items()):
+        archive.update()
+    changed = 0
+    for ymd, fingerprint in available.items():
+        if (ymd not in DATASET) or (DATASET[ymd]["fingerprint"] != fingerprint):
+            (ok, readings_pv, readings_house, wdata) = load_day(ymd)
+            DATASET[ymd] = { "fingerprint" : fingerprint, "ok" : ok }
+            if ok:
+                DATASET[ymd].update({ "weather" : np.array(wdata, dtype=float), "pv" : np.array(readings_pv, dtype=float), "house" : np.array(readings_house, dtype=float) })
+            changed += 1
+    for ymd in [ymd for ymd in DATASET if ymd not in available]:
+        del DATASET[ymd]
+        changed += 1
+    if changed > 0:
+        Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+        open(DATASET_FILE + ".tmp", "wb").write(pickle.dumps(DATASET))
+        os.replace(DATASET_FILE + ".tmp", DATASET_FILE)
+    return DATASET
+
+def stack_days(days):
+    # Returns contiguous (weather, pv, house) arrays for the given days from the dataset, one row per bin
+    blocks = [DATASET[ymd] for ymd in sorted(days)]
+    if len(blocks) == 0:
+        return np.zeros((0, NUM_FEATURES)), np.zeros(0), np.zeros(0)
+    return np.concatenate([b["weather"] for b in blocks]), np.concatenate([b["pv"] for b in blocks]), np.concatenate([b["house"] for b in blocks])
+
 def load_files():
+    # Load every usable day, and return the fingerprints of the days used
     global WEATHER_FORECAST, READINGS_PV, READINGS_HOUSE_ON_PEAK
-    files_read_ok = 0
-    files_not_read = 0
-    for f in sorted(os.listdir(DIRECTORY)):
-        if f.startswith("readings_"):
-            ymd = f[9:19]
-            if not os.path.exists(DIRECTORY + "weather_" + ymd + ".json"):
-                # print("Ignoring file",f,"as no corresponding weather file for that day")
-                files_not_read += 1
-            else:
-                (ok, readings_pv) = read_readings(DIRECTORY + f, "pv", measure_off_and_on_peak = True)
-                if not ok:
-                    files_not_read += 1
-                    continue
-                (ok, readings_house) = read_readings(DIRECTORY + f,"house", measure_off_and_on_peak = False)    # Only measure on-peak
-                if not ok:
-                    files_no_read += 1
-                    continue
-                (ok, wdata) = read_weather(ymd)
-                if not ok:
-                    files_not_read += 1
-                    continue
-                READINGS_PV.extend(readings_pv)
-                READINGS_HOUSE_ON_PEAK.extend(readings_house)
-                WEATHER_FORECAST.extend(wdata)
-                files_read_ok += 1
-    print("Read",files_read_ok,"files, ignored",files_not_read,"files, acquired",len(READINGS_PV),"readings")
+    dataset = load_dataset()
+    used = { ymd : entry["fingerprint"] for (ymd, entry) in dataset.items() if entry["ok"] }
+    WEATHER_FORECAST, READINGS_PV, READINGS_HOUSE_ON_PEAK = stack_days(used)    # Replaced, not extended, so repeated calls don't grow
+    print("Read",len(used),"files, ignored",len(dataset)-len(used),"files, acquired",len(READINGS_PV),"readings")
+    return used
 
 def print_results(predict):
     print("INDEX : INPUTS  : OUTPUT : PREDICT (ERROR)")
@@ -115,23 +176,38 @@ def print_results(predict):
         error += e
     print("Av RMS error %0.3f" % (error/len(READINGS_PV)))
 
-def learn_consumption():
-    # We're not really "learning" - just find average per bin
+def learn_consumption(dataset):
+    # Bring the consumption profile up to date with any new or changed days (each is O(1)), then predict today's consumption from it
     global CONSUMPTION_ON_PEAK_PREDICTION
-    CONSUMPTION_ON_PEAK_PREDICTION = [0] * BINS_PER_DAY
-    count = [0] * BINS_PER_DAY
-    for (w,r) in zip(WEATHER_FORECAST, READINGS_HOUSE_ON_PEAK):
-        bin = w[0]  # First element in weather array is bin number (we just happen to know)
-        CONSUMPTION_ON_PEAK_PREDICTION[bin] += r
-        count[bin] += 1
-    for b in range(BINS_PER_DAY):
-        CONSUMPTION_ON_PEAK_PREDICTION[b] /= float(count[b])
-    # print("CONSUMPTION_ON_PEAK_PREDICTION",CONSUMPTION_ON_PEAK_PREDICTION)
-    # print(sum(CONSUMPTION_ON_PEAK_PREDICTION))
+    changed = 0
+    for (ymd, entry) in dataset.items():
+        if entry["ok"] and consumption.add_day(ymd, entry["fingerprint"], entry["house"]):
+            changed += 1
+    for ymd in [ymd for ymd in consumption.days() if (ymd not in dataset) or not dataset[ymd]["ok"]]:
+        consumption.remove_day(ymd)
+        changed += 1
+    if changed > 0:
+        print(changed,"days added to consumption profile")
+        consumption.save()
+    CONSUMPTION_ON_PEAK_PREDICTION = consumption.predict(utcstuff.todays_date_iso8601())
+
+def ridge_on_onehot_bins():
+    # Ridge regression, with the bin number one-hot encoded too (time of day isn't linear)
+    return make_pipeline(ColumnTransformer([("bin", OneHotEncoder(categories=[list(range(BINS_PER_DAY))]), [0])], remainder="passthrough"), Ridge(alpha=1.0))
+
+MODELS = {  # Candidate PV models, by name. MODEL is the one we use, and "python ml.py benchmark" compares them all
+    "mlp 100x100x100" : lambda: MLPRegressor(random_state=1, max_iter=10000, hidden_layer_sizes = (100,100,100)),
+    "mlp 20x20" : lambda: MLPRegressor(random_state=1, max_iter=10000, hidden_layer_sizes = (20,20)),
+    "mlp 10" : lambda: MLPRegressor(random_state=1, max_iter=10000, hidden_layer_sizes = (10,)),
+    "ridge" : ridge_on_onehot_bins,
+    "gradient boosting" : lambda: GradientBoostingRegressor(random_state=1),
+    "hist gradient boosting" : lambda: HistGradientBoostingRegressor(random_state=1),
+}
+MODEL = "mlp 100x100x100"
 
 def learn_weather():
     global CLF
-    CLF = MLPRegressor(random_state=1, max_iter=10000, hidden_layer_sizes = (100,100,100))
+    CLF = MODELS[MODEL]()
     t1 = time.time()
     CLF.fit(WEATHER_FORECAST, READINGS_PV)
     t2 = time.time()
@@ -155,10 +231,54 @@ def predict_battery():
     if rng > batt_kwh:
         print("Cannot satisfy requirement - battery too small")
 
+def save_model(days):
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    state = { "days" : days, "model" : MODEL, "clf" : CLF }
+    open(MODEL_FILE + ".tmp", "wb").write(pickle.dumps(state))
+    os.replace(MODEL_FILE + ".tmp", MODEL_FILE)    # Atomic, so we never load a half-written model
+
+def load_model():
+    if not os.path.exists(MODEL_FILE):
+        return None
+    try:
+        return pickle.loads(open(MODEL_FILE, "rb").read())
+    except Exception:
+        print("Could not load saved model, so will retrain")
+        traceback.print_exc(file=sys.stdout)
+        return None
+
 def learn():
-    load_files()
-    learn_consumption()
-    learn_weather()
+    # Fitting from scratch is slow, so we keep the fitted model on disk along with the fingerprints of the days it was trained on.
+    # If those days are unchanged we just load it, and if there are new days we show the model just those.
+    global CLF
+    state = load_model()
+    dataset = load_dataset()
+    learn_consumption(dataset)
+    if (state is None) or (state.get("model") != MODEL) or any((ymd not in dataset) or (dataset[ymd]["fingerprint"] != fingerprint) for (ymd, fingerprint) in state["days"].items()):
+        print("Training from scratch")
+        days = load_files()
+        learn_weather()
+        save_model(days)
+        return
+
+    CLF = state["clf"]
+    days = state["days"]
+    print("Loaded saved model trained on",len(days),"days")
+    new_days = [ymd for ymd in dataset if (ymd not in days) and dataset[ymd]["ok"]]
+    wdata, readings_pv, _ = stack_days(new_days)
+    for ymd in new_days:
+        days[ymd] = dataset[ymd]["fingerprint"]
+    print(len(wdata)//BINS_PER_DAY,"new days to learn")
+    if (len(wdata) > 0) and not hasattr(CLF, "partial_fit"):    # Not all models can learn incrementally, but those that can't are cheap to refit
+        load_files()
+        learn_weather()
+        save_model(days)
+    elif len(wdata) > 0:
+        t1 = time.time()
+        for i in range(PARTIAL_FIT_PASSES):
+            CLF.partial_fit(wdata, readings_pv)
+        print("Updating fit took %1.1fs" % (time.time()-t1))
+        save_model(days)
 
 def learn_and_predict(wdata, is_raw=True):
     global CLF, PV_PREDICTION
@@ -168,12 +288,145 @@ def learn_and_predict(wdata, is_raw=True):
     PV_PREDICTION = CLF.predict(wdata)
     predict_battery()
 
+def _learn_and_predict_in_worker(wdata, is_raw):
+    # Runs in the worker process, whose module globals are its own, so hand back the results
+    learn_and_predict(wdata, is_raw)
+    return PV_PREDICTION, CONSUMPTION_ON_PEAK_PREDICTION
+
+def start_learn_and_predict(wdata, is_raw=True):
+    # Like learn_and_predict(), but done by a separate worker process so the caller never waits. Call poll_prediction() to pick up the result.
+    # Until then the previous predictions remain in place, marked by PREDICTION_STALE
+    global WORKER, PENDING, PREDICTION_STALE
+    if WORKER is None:
+        # A fresh process rather than a fork of this one, as by now we have other threads (e.g. the sofar poller), the serial port and the display
+        WORKER = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    PENDING = WORKER.submit(_learn_and_predict_in_worker, wdata, is_raw)    # If a previous request is still running, this queues behind it and supersedes it
+    PREDICTION_STALE = True
+
+def stop_worker():
+    # Abandon any learning in progress and stop the worker, e.g. when we quit (otherwise exiting waits for the worker to finish)
+    global WORKER, PENDING
+    if WORKER is None:
+        return
+    processes = list((WORKER._processes or {}).values())   # There's no public way to kill the worker's process (before Python 3.14)
+    WORKER.shutdown(wait=False, cancel_futures=True)
+    for p in processes:
+        p.terminate()
+    WORKER, PENDING = None, None
+
+def poll_prediction():
+    # Publishes the latest worker result, if it has arrived. Returns True if the predictions changed.
+    global PENDING, PREDICTION_STALE, PV_PREDICTION, CONSUMPTION_ON_PEAK_PREDICTION
+    if (PENDING is None) or not PENDING.done():
+        return False
+    future = PENDING
+    PENDING = None
+    try:
+        pv, house = future.result()
+    except Exception:
+        print("Exception in background learning, so keeping previous predictions")
+        traceback.print_exc(file=sys.stdout)
+        return False
+    PV_PREDICTION, CONSUMPTION_ON_PEAK_PREDICTION = pv, house  # Both together, between frames
+    PREDICTION_STALE = False
+    return True
+
 def predict_only(raw_wdata):
     wdata = relevant_weather_fields(raw_wdata)
     prediction = CLF.predict(wdata)
     return prediction
 
+def backcast():
+    # "Prediction vs. reality": predict PV for every day we have a usable weather forecast for, in a single predict() call,
+    # and compare each day with the PV actually generated. Run after any model change.
+    learn()
+    dataset = load_dataset()
+    days = []
+    raws = []
+    skipped = 0
+    for ymd in filer.list_names("weather"):
+        try:
+            raw = filer.read_file("weather", ymd)["raw"]
+        except Exception:
+            raw = []
+        if (len(raw) != BINS_PER_DAY) or any("W" not in r for r in raw):
+            skipped += 1
+            continue
+        days.append(ymd)
+        raws.append(raw)
+    if len(days) == 0:
+        print("No usable weather files to back-cast")
+        return
+    t1 = time.time()
+    predicted = CLF.predict(weather_features(raws)).reshape(len(days), BINS_PER_DAY).sum(axis=1)
+    print("Back-casted PV predictions for",len(days),"days (skipped",skipped,"weather files) in %1.3fs" % (time.time()-t1))
+
+    actual = np.array([dataset[ymd]["pv"].sum() if (ymd in dataset) and dataset[ymd]["ok"] else np.nan for ymd in days])
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    lines = ["date,predicted_kWh,actual_kWh,error_kWh"]
+    for (ymd, p, a) in zip(days, predicted, actual):
+        if np.isnan(a):
+            lines.append("%s,%.3f,," % (ymd, p))
+        else:
+            lines.append("%s,%.3f,%.3f,%.3f" % (ymd, p, a, p-a))
+    open(BACKCAST_FILE, "wt").write("\n".join(lines) + "\n")
+    print("Wrote",BACKCAST_FILE)
+
+    known = ~np.isnan(actual)
+    if not known.any():
+        print("No actual PV readings to compare with")
+        return
+    errors = predicted[known] - actual[known]
+    print("Compared",int(known.sum()),"days with actual PV:")
+    print("  Total predicted %1.1f kWh, actual %1.1f kWh" % (predicted[known].sum(), actual[known].sum()))
+    print("  Daily MAE %1.2f kWh, RMSE %1.2f kWh, bias %+1.2f kWh" % (np.abs(errors).mean(), np.sqrt((errors * errors).mean()), errors.mean()))
+    print("  Worst day %s (%+1.2f kWh)" % (np.array(days)[known][np.abs(errors).argmax()], errors[np.abs(errors).argmax()]))
+
+def benchmark():
+    # Compare all MODELS on speed & accuracy, by time-ordered cross-validation over whole days (always training on the past and testing on the following days)
+    load_files()
+    days = len(READINGS_PV) // BINS_PER_DAY
+    print("Benchmarking",len(MODELS),"models on",days,"days of history with",BENCHMARK_FOLDS,"folds")
+    results = []
+    for name, make_model in MODELS.items():
+        fit_s = 0
+        peak_bytes = 0
+        predict_s = []
+        daily_errors = []
+        for train_days, test_days in TimeSeriesSplit(n_splits=BENCHMARK_FOLDS).split(np.arange(days)):
+            train = (train_days[:, np.newaxis] * BINS_PER_DAY + np.arange(BINS_PER_DAY)).ravel()
+            test = (test_days[:, np.newaxis] * BINS_PER_DAY + np.arange(BINS_PER_DAY)).ravel()
+            model = make_model()
+            tracemalloc.start()
+            t1 = time.time()
+            model.fit(WEATHER_FORECAST[train], READINGS_PV[train])
+            fit_s += time.time() - t1
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+            for i in range(BENCHMARK_PREDICTS):  # Latency of predicting a single day, as we do live
+                t1 = time.time()
+                model.predict(WEATHER_FORECAST[test[0:BINS_PER_DAY]])
+                predict_s.append(time.time() - t1)
+            predicted = model.predict(WEATHER_FORECAST[test]).reshape(-1, BINS_PER_DAY).sum(axis=1)
+            actual = READINGS_PV[test].reshape(-1, BINS_PER_DAY).sum(axis=1)
+            daily_errors.extend(predicted - actual)
+        daily_errors = np.array(daily_errors)
+        results.append((name, fit_s / BENCHMARK_FOLDS, np.median(predict_s), peak_bytes, np.abs(daily_errors).mean(), np.sqrt((daily_errors ** 2).mean())))
+        print("Benchmarked",name)
+
+    print("%-24s %10s %12s %10s %14s %15s" % ("MODEL", "FIT (s)", "PREDICT (ms)", "PEAK (MB)", "DAILY MAE kWh", "DAILY RMSE kWh"))
+    for (name, fit_s, predict_s, peak_bytes, mae, rmse) in results:
+        print("%-24s %10.2f %12.2f %10.1f %14.2f %15.2f" % (name, fit_s, predict_s * 1000, peak_bytes / 1e6, mae, rmse))
+
 if __name__ == "__main__":
+    if (len(sys.argv) > 1) and (sys.argv[1] == "benchmark"):   # python ml.py benchmark
+        benchmark()
+        sys.exit()
+    if (len(sys.argv) > 1) and (sys.argv[1] == "backcast"):   # python ml.py backcast
+        backcast()
+        sys.exit()
+
     # Predict today's weather forecast
     # todays_date = utcstuff.todays_date_iso8601()
     # (ok, today_forecast) = read_weather(todays_date)
@@ -183,5 +436,6 @@ if __name__ == "__main__":
 
     # Predict on all weather data (should really be a separate dataset)
     learn()
+    load_files()    # learn() may not have needed to load everything
     p = CLF.predict(WEATHER_FORECAST)
     print_results(p)
@@ -0,0 +1,72 @@
+# Store of half-hourly electricity prices, read from CSV files of "<ISO date>,<price>" lines (e.g. Octopus Agile exports in pence/kWh)
+# Parsing text is slow, so each CSV is parsed once into a binary sidecar in CACHE_DIR: an array of prices indexed by half-hour (NaN where there is no price)
+# The sidecar is memory-mapped on later runs for as long as the CSV's mtime and size are unchanged
+
+import os
+import json
+from pathlib import Path
+import numpy as np
+
+CACHE_DIR = "../bc_cache/"
+HALF_AN_HOUR_S = 60*30
+
+def parse_csv(fname):
+    # Returns arrays of (half-hour, price), parsed in bulk rather than line-by-line. Dates without a UTC offset are taken to be UTC.
+    text = np.loadtxt(fname, delimiter=",", dtype=str, ndmin=2)
+    dates = text[:,0]
+    prices = text[:,1].astype(float)
+    epochs = dates.astype("U19").astype("datetime64[s]").astype(np.int64)
+    tails = np.ascontiguousarray(dates.astype("U25").view("U1").reshape(len(dates), 25)[:,19:]).view("U6").ravel()    # e.g. "+00:00"
+    unique_tails, which = np.unique(tails, return_inverse=True)
+    offsets_s = np.zeros(len(unique_tails), dtype=np.int64)
+    for i, tail in enumerate(unique_tails):   # There are only ever one or two of these
+        if len(tail) == 6:
+            offsets_s[i] = (int(tail[1:3]) * 60 + int(tail[4:6])) * 60 * (-1 if tail[0] == "-" else 1)
+    epochs -= offsets_s[which.ravel()]
+    return epochs // HALF_AN_HOUR_S, prices
+
+def sidecar_names(fname):
+    base = CACHE_DIR + os.path.basename(fname)
+    return base + ".npy", base + ".json"
+
+def build_sidecar(fname):
+    hhs, values = parse_csv(fname)
+    first_hh = int(hhs.min())
+    prices = np.full(int(hhs.max()) - first_hh + 1, np.nan)
+    prices[hhs - first_hh] = values
+    duplicates = len(hhs) - len(np.unique(hhs))
+    if duplicates > 0:
+        print(fname,"has",duplicates,"duplicate half-hours")
+
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    array_name, meta_name = sidecar_names(fname)
+    st = os.stat(fname)
+    np.save(array_name + ".tmp.npy", prices)
+    os.replace(array_name + ".tmp.npy", array_name)
+    open(meta_name + ".tmp","wt").write(json.dumps({ "mtime" : st.st_mtime, "size" : st.st_size, "first_hh" : first_hh }))
+    os.replace(meta_name + ".tmp", meta_name)   # Written last, so a sidecar is only trusted once both parts are complete
+
+def load_price_file(fname):
+    # Returns (first_hh, prices), where prices is a read-only memory-mapped array with one entry per half-hour from first_hh, NaN where missing
+    array_name, meta_name = sidecar_names(fname)
+    st = os.stat(fname)
+    meta = None
+    if os.path.exists(meta_name) and os.path.exists(array_name):
+        meta = json.loads(open(meta_name,"rt").read())
+    if (meta is None) or (meta["mtime"] != st.st_mtime) or (meta["size"] != st.st_size):
+        print("Parsing price file",fname)
+        build_sidecar(fname)
+        meta = json.loads(open(meta_name,"rt").read())
+    return meta["first_hh"], np.load(array_name, mmap_mode="r")
+
+def load_prices(fnames, series):
+    # Fill a HalfHourSeries with prices from several files (e.g. one per year). Returns (number outside the series' range, number of half-hours priced more than once)
+    outside = 0
+    duplicates = 0
+    for fname in fnames:
+        first_hh, prices = load_price_file(fname)
+        offsets = np.flatnonzero(~np.isnan(prices))
+        o, d = series.set(offsets + first_hh, prices[offsets])
+        outside += o
+        duplicates += d
+    return outside, duplicates
@@ -1,8 +1,13 @@
 # (credits)
 # (rights)
 #
-# We run at the default bus speed of 9600, which is slow. So getting all registers can take about 3s, which causes unacceptable lag in UI
-# Therefore we get registers one by one in rotation, and maintain a cache of all values
+# We run at the default bus speed of 9600, which is slow. So getting all registers one at a time can take about 3s, which causes unacceptable lag in UI
+# Most of the cost is per-transaction rather than per-register, so by default (BLOCK_READS) we read the registers we want in as few
+# multi-register transactions as possible - all of those below are in one contiguous span, so one round trip gets a consistent snapshot.
+# Not everything needs reading every time though: daily odometers only move in 0.01kWh steps, whereas battery power is integrated to get
+# battery kWh so wants reading as often as possible. So by default (SCHEDULED_READS) each register has a target refresh interval and a
+# priority (POLL_SCHEDULE) and each call reads just the registers that are due, most important first, within a budget of bus time.
+# Otherwise we get registers one by one in rotation, and maintain a cache of all values
 #
 # The SOFAR registers include:
 # . Realtime stuff e.g. power
@@ -15,16 +20,38 @@
 
 import time
 import sys, traceback
-import minimalmodbus
-import serial
+import threading
+from collections import namedtuple
+from types import MappingProxyType
 from pprint import pprint
 
-instrument = minimalmodbus.Instrument('/dev/ttyUSB0', 1) # port name, slave address
-instrument.serial.baudrate = 9600 # Baud
-instrument.serial.bytesize = 8
-instrument.serial.parity   = serial.PARITY_NONE
-instrument.serial.stopbits = 1
-instrument.serial.timeout  = 0.5   # seconds
+PORT = '/dev/ttyUSB0'
+SLAVE_ADDRESS = 1
+BAUD_RATE = 9600
+
+instrument = None   # Opened when first needed. See set_transport() to use something else, e.g. sofar_sim
+
+def open_instrument():
+    import minimalmodbus
+    import serial
+    result = minimalmodbus.Instrument(PORT, SLAVE_ADDRESS)
+    result.serial.baudrate = BAUD_RATE
+    result.serial.bytesize = 8
+    result.serial.parity   = serial.PARITY_NONE
+    result.serial.stopbits = 1
+    result.serial.timeout  = 0.5   # seconds
+    return result
+
+def set_transport(transport):
+    # Anything with minimalmodbus's read_register() and read_registers() methods, and serial.baudrate
+    global instrument
+    instrument = transport
+
+def get_instrument():
+    global instrument
+    if instrument is None:
+        instrument = open_instrument()
+    return instrument
 
 modbus_registers = [
     #Name                        addr   signed mul  units twowords
@@ -47,34 +74,162 @@ modbus_registers = [
     #["Total House Consumption", 0x222, False, 1,    "kWh",True],
 ]
 
+POLL_SCHEDULE = {   # Name : (target refresh interval in seconds, priority - lower is more important). Registers not listed use DEFAULT_SCHEDULE
+    "Battery Charge Power" :    (1, 0),
+    "Grid Power" :              (2, 1),
+    "House Consumption" :       (2, 1),
+    "PV Power" :                (2, 1),
+    "Battery Charge Level" :    (10, 2),
+    "Daily Generation" :        (30, 3),
+    "Daily Export" :            (30, 3),
+    "Daily Import" :            (30, 3),
+    "Daily House Consumption" : (30, 3),
+}
+DEFAULT_SCHEDULE = (10, 2)
+CALL_BUDGET_S = 0.1     # Bus time we'll spend per call (though the most important due register is always read)
+LATENCY_EWMA = 0.2      # How quickly our estimate of per-transaction overhead follows measurements
+
+SCHEDULED_READS = True  # Read just the registers which are due, per POLL_SCHEDULE. If False then see BLOCK_READS.
+BLOCK_READS = True      # Read all registers every call, in as few transactions as possible. If False then read NUM_READS_PER_CALL registers per call.
+MAX_BLOCK_REGISTERS = 125   # Modbus limit for one read
+MAX_BLOCK_GAP = 8       # Read up to this many unwanted registers, rather than start another transaction (a register costs ~2ms at 9600 baud, a transaction ~30ms)
+RETRY_DELAY_S = 10
+POLL_INTERVAL_S = 0.25  # Pause between reads by the background poller
+
 NUM_READS_PER_CALL = 1  # How many registers to read per call. Set equal to number of registers to read all every call
 next_reg_to_read = 0
 cached_values = {}
 
 time_of_last_battery_charge_power_read = None
+# Once start_poller() has been called, a background thread owns the serial port and all the state above, and the rest of the program
+# only sees the immutable snapshots it publishes. Battery kWh in a snapshot are totals since the poller started, so difference them.
+Snapshot = namedtuple("Snapshot", ["time", "values", "ages", "battery_charge_kWh", "battery_discharge_kWh"])
+SNAPSHOT = None
+FIRST_SNAPSHOT = threading.Event()
+POLLER = None
+
+transaction_overhead_s = 0.03   # Measured, see _read_words()
+last_read_time = {} # Name : epoch-time
 
 def _read_reg(r):
     (name, reg, signed, mul, units, twowords) = modbus_registers[r]
-    result = instrument.read_register(reg, 0, functioncode=3, signed=signed) 
+    result = get_instrument().read_register(reg, 0, functioncode=3, signed=signed) 
     if twowords:
         result *= 65536
-        result += instrument.read_register(reg+1, 0, functioncode=3, signed=signed)
+        result += get_instrument().read_register(reg+1, 0, functioncode=3, signed=signed)
     result *= mul
     values = { name : { "value" : result, "text" : str(result)+units } }
+    last_read_time[name] = time.time()
     return values
 
-def read_reg(r):
+def with_retries(fn, description):
+    # Keep trying until it works
     attempt = 0
     while True:
         try:
-            return _read_reg(r)
+            return fn()
         except Exception:
-            print("Exception reading modbus register",r)
+            print("Exception reading modbus", description)
             print("Attempt", attempt)
             traceback.print_exc(file=sys.stdout)
-            time.sleep(10)
+            time.sleep(RETRY_DELAY_S)
             attempt += 1
 
+def read_reg(r):
+    return with_retries(lambda: _read_reg(r), "register " + str(r))
+
+def plan_blocks(registers, max_gap=MAX_BLOCK_GAP):
+    # Returns a list of (start address, count) spans which between them cover all the given registers, in as few reads as possible
+    addresses = set()
+    for (name, reg, signed, mul, units, twowords) in registers:
+        addresses.add(reg)
+        if twowords:
+            addresses.add(reg+1)
+    blocks = []
+    for a in sorted(addresses):
+        if blocks and (a - (blocks[-1][0] + blocks[-1][1]) <= max_gap) and (a - blocks[-1][0] < MAX_BLOCK_REGISTERS):
+            blocks[-1][1] = a - blocks[-1][0] + 1
+        else:
+            blocks.append([a, 1])
+    return [tuple(b) for b in blocks]
+
+def decode(words, register):
+    # words is { address : unsigned 16-bit word }
+    (name, reg, signed, mul, units, twowords) = register
+    if twowords:
+        result = words[reg] * 65536 + words[reg+1]
+        bits = 32
+    else:
+        result = words[reg]
+        bits = 16
+    if signed and result >= (1 << (bits-1)):
+        result -= 1 << bits
+    result *= mul
+    return { name : { "value" : result, "text" : str(result)+units } }
+
+def register_time_s():
+    # Time on the wire for each extra register in a read: 2 bytes of 10 bits (inc. start & stop)
+    return 20.0 / get_instrument().serial.baudrate
+
+def _read_words(blocks):
+    # Returns { address : word } for all the blocks, and keeps our estimate of per-transaction overhead up to date
+    global transaction_overhead_s
+    words = {}
+    for (start, count) in blocks:
+        t1 = time.time()
+        words.update(zip(range(start, start+count), get_instrument().read_registers(start, count, functioncode=3)))
+        overhead = time.time() - t1 - count * register_time_s()
+        transaction_overhead_s += LATENCY_EWMA * (overhead - transaction_overhead_s)
+    return words
+
+def decode_all(words):
+    # Decodes every register that words covers, noting when each was read
+    values = {}
+    for register in modbus_registers:
+        if (register[1] in words) and ((not register[5]) or (register[1]+1 in words)):
+            values.update(decode(words, register))
+            last_read_time[register[0]] = time.time()
+    return values
+
+def _read_blocks():
+    return decode_all(_read_words(BLOCKS))
+
+def read_blocks():
+    return with_retries(_read_blocks, "registers in " + str(len(BLOCKS)) + " block(s)")
+
+def schedule(name):
+    return POLL_SCHEDULE.get(name, DEFAULT_SCHEDULE)
+
+def plan_scheduled_blocks():
+    # Choose which of the due registers to read this call, and returns the blocks to read them in.
+    # It's worth reading a few unwanted registers rather than starting a new transaction, and how many depends on the latency we're seeing.
+    now = time.time()
+    max_gap = int(transaction_overhead_s / register_time_s())
+    def age(r):
+        return now - last_read_time.get(r[0], 0)
+    due = [r for r in modbus_registers if age(r) >= schedule(r[0])[0]]
+    due.sort(key = lambda r: (schedule(r[0])[1], -age(r) / schedule(r[0])[0]))   # Most important first, then most overdue
+    chosen = []
+    for r in due:
+        blocks = plan_blocks(chosen + [r], max_gap)
+        if chosen and (sum([transaction_overhead_s + count * register_time_s() for (start, count) in blocks]) > CALL_BUDGET_S):
+            continue    # Won't fit this time, but a later (less important) one might, e.g. if it's in a block we're already reading
+        chosen.append(r)
+    return plan_blocks(chosen, max_gap)
+
+def read_scheduled():
+    blocks = plan_scheduled_blocks()
+    if len(blocks) == 0:
+        return {}
+    return with_retries(lambda: decode_all(_read_words(blocks)), "registers in " + str(len(blocks)) + " block(s)")
+
+def register_ages():
+    # How long ago each register was last read, in seconds
+    now = time.time()
+    return { r[0] : now - last_read_time[r[0]] for r in modbus_registers if r[0] in last_read_time }
+
+BLOCKS = plan_blocks(modbus_registers)
+
 def set_synthetics(charge):
     if charge > 0 :
         cha = charge
@@ -86,10 +241,33 @@ def set_synthetics(charge):
     cached_values["Battery Charge kWh"] =    { "value" : cha, "text" : str(cha)+"kWh" }
     cached_values["Battery Discharge kWh"] = { "value" : dis, "text" : str(dis)+"kWh" }
 
+def integrate_battery_power(v):
+    # Use a fresh reading of battery power to drive the synthetic registers
+    global time_of_last_battery_charge_power_read
+    if time_of_last_battery_charge_power_read is not None:
+        val = v["Battery Charge Power"]["value"]
+        elapsed = time.time() - time_of_last_battery_charge_power_read
+        kWh = (val / 1000.0) * elapsed / (60 * 60)
+        set_synthetics(kWh)
+    else:
+        set_synthetics(0)
+    time_of_last_battery_charge_power_read = time.time()
+
 def read_sofar():
-    global cached_values, next_reg_to_read, time_of_last_battery_charge_power_read
+    global cached_values, next_reg_to_read
     t1 = time.time()
-    if cached_values == {}:
+    if SCHEDULED_READS:
+        v = read_scheduled()
+        cached_values = {**cached_values, **v}    # A new dict, so callers holding on to the previous values don't see them change
+        if "Battery Charge Power" in v:
+            integrate_battery_power(v)
+        else:
+            set_synthetics(0)
+    elif BLOCK_READS:
+        v = read_blocks()
+        cached_values = v  # A new dict, so callers holding on to the previous values don't see them change
+        integrate_battery_power(v)
+    elif cached_values == {}:
         for r in range(len(modbus_registers)):
             cached_values.update(read_reg(r))
         set_synthetics(0)
@@ -98,12 +276,7 @@ def read_sofar():
             v = read_reg(next_reg_to_read)
             cached_values.update(v)
             if modbus_registers[next_reg_to_read][0] == "Battery Charge Power": # If we just read battery power, use it to drive synthetic registers 
-                if time_of_last_battery_charge_power_read is not None:
-                    val = v["Battery Charge Power"]["value"]
-                    elapsed = time.time() - time_of_last_battery_charge_power_read
-                    kWh = (val / 1000.0) * elapsed / (60 * 60)
-                    set_synthetics(kWh)
-                time_of_last_battery_charge_power_read = time.time()
+                integrate_battery_power(v)
             else:
                 set_synthetics(0)
             next_reg_to_read = (next_reg_to_read + 1) % len(modbus_registers)
@@ -116,7 +289,53 @@ def read_sofar():
 def prev_values():
     return cached_values
 
+def take_snapshot(prev):
+    values = read_sofar()
+    charge = values["Battery Charge kWh"]["value"]
+    discharge = values["Battery Discharge kWh"]["value"]
+    if prev is not None:
+        charge += prev.battery_charge_kWh
+        discharge += prev.battery_discharge_kWh
+    frozen = MappingProxyType({ name : MappingProxyType(dict(v)) for (name, v) in values.items() })
+    return Snapshot(time.time(), frozen, MappingProxyType(register_ages()), charge, discharge)
+
+def _poll():
+    global SNAPSHOT
+    while True:
+        try:
+            SNAPSHOT = take_snapshot(SNAPSHOT)  # A single assignment, so readers never see a half-made snapshot and need no lock
+            FIRST_SNAPSHOT.set()
+        except Exception:
+            print("Exception in sofar poller")
+            traceback.print_exc(file=sys.stdout)
+            time.sleep(RETRY_DELAY_S)
+        time.sleep(POLL_INTERVAL_S)
+
+def start_poller():
+    global POLLER
+    if POLLER is None:
+        POLLER = threading.Thread(target=_poll, name="sofar poller", daemon=True)
+        POLLER.start()
+
+def snapshot():
+    # The latest snapshot (or None if there isn't one yet). Never blocks.
+    return SNAPSHOT
+
+def wait_for_snapshot(timeout_s):
+    # Wait (but no longer than timeout_s) for the first snapshot
+    FIRST_SNAPSHOT.wait(timeout_s)
+    return SNAPSHOT
+
+def snapshot_age(snap):
+    return time.time() - snap.time
+
 if __name__ == "__main__":
+    print("Reading in blocks", BLOCKS)
+    if SCHEDULED_READS:
+        for i in range(60):
+            read_sofar()
+            print(" ".join(["%s %1.0fs" % (name, age) for (name, age) in register_ages().items()]), "(overhead %1.0fms)" % (transaction_overhead_s * 1000))
+            time.sleep(0.5)
     print("First read should read all registers")
     pprint(read_sofar(), width=132)
 
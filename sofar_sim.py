@@ -0,0 +1,179 @@
+# A stand-in for the Sofar inverter, so that polling can be tried out (and measured) without one
+# It serves the registers in sofar.modbus_registers from a simple model of a house with PV and a battery, with the time on the wire
+# of a real 9600 baud link, occasional corrupt replies and timeouts, and the daily odometers going back to zero at (UTC) midnight.
+#
+# python sofar_sim.py [seconds] [error_rate] [timeout_rate]     Benchmark the sofar poller against the simulator
+
+import sys
+import time
+import math
+import random
+import types
+import numpy as np
+
+import sofar
+
+TURNAROUND_S = 0.02     # Time for the inverter to start replying
+BATTERY_KWH = 10
+BATTERY_MAX_W = 3000
+PV_PEAK_W = 3000
+
+DAILY_ODOMETERS = ["Daily Generation", "Daily Export", "Daily Import", "Daily House Consumption"]
+
+class SimulatedInverter:
+    def __init__(self, baudrate=9600, error_rate=0.0, timeout_rate=0.0, timeout_s=0.5, start_time=None, seed=1):
+        self.serial = types.SimpleNamespace(baudrate=baudrate, timeout=timeout_s)    # As much of minimalmodbus's serial port as sofar uses
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.random = random.Random(seed)
+        self.offset = 0 if start_time is None else start_time - time.time()   # So we can start just before midnight, say
+        self.failing_until = 0
+        self.transactions = 0
+        self.registers_read = 0
+        self.errors = 0
+        self.timeouts = 0
+
+        now = self.now()
+        hours = (now % 86400) / 3600.0
+        self.last_update = now
+        self.soc = 50.0
+        self.daily = {   # Roughly what the odometers would say by this time of day
+            "Daily Generation" : 0.0,
+            "Daily Export" : 0.0,
+            "Daily Import" : hours * 0.2,
+            "Daily House Consumption" : hours * 0.4 }
+        self.update()
+
+    def now(self):
+        return time.time() + self.offset
+
+    def fail_until(self, t):
+        # Simulate a dead link (every request times out) until real time t
+        self.failing_until = t
+
+    def powers(self, t):
+        # Returns (pv, house, battery) in W at time t
+        hours = (t % 86400) / 3600.0
+        pv = max(0.0, PV_PEAK_W * math.sin(math.pi * (hours - 6) / 12))
+        house = 300 + 200 * math.sin(math.pi * hours / 12) ** 2 + self.random.uniform(0, 100)
+        battery = max(-BATTERY_MAX_W, min(BATTERY_MAX_W, pv - house))  # +ve is charging
+        if (battery > 0 and self.soc >= 100) or (battery < 0 and self.soc <= 0):
+            battery = 0.0
+        return pv, house, battery
+
+    def update(self):
+        # Bring the model up to date, integrating energies since last time
+        now = self.now()
+        if int(now // 86400) != int(self.last_update // 86400):
+            for name in DAILY_ODOMETERS:
+                self.daily[name] = 0.0  # Midnight
+        pv, house, battery = self.powers(now)
+        grid = house + battery - pv    # +ve is importing
+        hours = (now - self.last_update) / 3600.0
+        self.daily["Daily Generation"] += pv * hours / 1000
+        self.daily["Daily House Consumption"] += house * hours / 1000
+        self.daily["Daily Import"] += max(0.0, grid) * hours / 1000
+        self.daily["Daily Export"] += max(0.0, -grid) * hours / 1000
+        self.soc = max(0.0, min(100.0, self.soc + 100 * battery * hours / 1000 / BATTERY_KWH))
+        self.last_update = now
+        self.values = {
+            "Battery Charge Power" : battery,
+            "Battery Charge Level" : self.soc,
+            "Grid Power" : grid,
+            "House Consumption" : house,
+            "PV Power" : pv,
+            **self.daily }
+
+    def words(self):
+        # Returns { address : word } for every register in sofar's map
+        words = {}
+        for (name, reg, signed, mul, units, twowords) in sofar.modbus_registers:
+            v = int(round(self.values.get(name, 0) / mul))
+            if twowords:
+                v &= 0xffffffff
+                words[reg], words[reg+1] = v >> 16, v & 0xffff
+            else:
+                words[reg] = v & 0xffff
+        return words
+
+    def transaction(self, start, count):
+        self.transactions += 1
+        if (time.time() < self.failing_until) or (self.random.random() < self.timeout_rate):
+            self.timeouts += 1
+            time.sleep(self.serial.timeout)
+            raise IOError("No communication with the instrument (no answer)")
+        request_bytes = 8
+        reply_bytes = 5 + 2 * count
+        time.sleep(TURNAROUND_S + (request_bytes + reply_bytes) * 10.0 / self.serial.baudrate)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            raise IOError("Checksum error in rtu mode")
+        self.update()
+        words = self.words()
+        self.registers_read += count
+        return [words.get(a, 0) for a in range(start, start+count)]
+
+    # The minimalmodbus.Instrument methods that sofar uses
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        return self.transaction(registeraddress, number_of_registers)
+
+    def read_register(self, registeraddress, number_of_decimals=0, functioncode=3, signed=False):
+        v = self.transaction(registeraddress, 1)[0]
+        if signed and v >= 0x8000:
+            v -= 0x10000
+        return v
+
+def benchmark(seconds=60, error_rate=0.02, timeout_rate=0.01, outage_every_s=20, outage_s=3):
+    # Runs the sofar poller against the simulator, reading snapshots as main.py would, with a dead link every so often.
+    # The simulated clock starts so that midnight falls half-way through.
+    midnight = (time.time() // 86400 + 1) * 86400
+    sim = SimulatedInverter(error_rate=error_rate, timeout_rate=timeout_rate, start_time=midnight - seconds/2)
+    sofar.set_transport(sim)
+    print("Benchmarking sofar poller for",seconds,"s with error rate",error_rate,"timeout rate",timeout_rate,"and a",outage_s,"s outage every",outage_every_s,"s")
+    t0 = time.time()
+    sofar.start_poller()
+    first = sofar.wait_for_snapshot(seconds)
+    if first is None:
+        print("No snapshot at all")
+        return
+    print("First snapshot after %1.2fs" % (first.time - t0))
+
+    latencies = []
+    recoveries = []
+    wraps = 0
+    snapshots = 0
+    outage_end = None
+    next_outage = time.time() + outage_every_s
+    prev = first
+    while time.time() - t0 < seconds:
+        now = time.time()
+        if now >= next_outage:
+            sim.fail_until(now + outage_s)
+            outage_end = now + outage_s
+            next_outage += outage_every_s
+        snap = sofar.snapshot()
+        latencies.append(now - snap.time)
+        if snap is not prev:
+            snapshots += 1
+            if snap.values["Daily House Consumption"]["value"] < prev.values["Daily House Consumption"]["value"]:
+                wraps += 1
+            if (outage_end is not None) and (snap.time > outage_end):
+                recoveries.append(snap.time - outage_end)
+                outage_end = None
+        prev = snap
+        time.sleep(0.05)
+
+    elapsed = time.time() - t0
+    latencies = np.array(latencies)
+    print("Transactions  %1.1f/s (%d errors, %d timeouts)" % (sim.transactions / elapsed, sim.errors, sim.timeouts))
+    print("Registers     %1.1f/s" % (sim.registers_read / elapsed))
+    print("Snapshots     %1.1f/s" % (snapshots / elapsed))
+    print("Snapshot age  p50 %1.2fs  p90 %1.2fs  p99 %1.2fs  max %1.2fs" % tuple(np.percentile(latencies, [50, 90, 99, 100])))
+    if recoveries:
+        print("Recovery      mean %1.2fs  max %1.2fs after %d outages" % (np.mean(recoveries), np.max(recoveries), len(recoveries)))
+    print("Register ages", " ".join(["%s %1.1fs" % (name, age) for (name, age) in sofar.snapshot().ages.items()]))
+    print("Odometers went back to zero",wraps,"time(s)")
+
+if __name__ == "__main__":
+    args = [float(a) for a in sys.argv[1:]]
+    benchmark(*args)
@@ -0,0 +1,82 @@
+# Position of the sun (azimuth & elevation) for whole arrays of epoch-times
+# Setting up astropy for a single time is slow, so we work out positions on a fixed grid of times (every QUANTUM_S seconds) in one call,
+# and keep them in an on-disk lookup table per location. After the first run, years of positions are just an array lookup.
+
+import os
+from pathlib import Path
+import numpy as np
+from astropy.time import Time
+from astropy.coordinates import get_sun, EarthLocation, AltAz
+import astropy.units as astro_units
+
+CACHE_DIR = "../bc_cache/"
+QUANTUM_S = 5 * 60  # Sun moves about 1.25 degrees in 5 minutes
+
+TABLES = {} # In-memory copies of the on-disk tables, by filename
+
+def calculate_azi_elev(epochs, latitude, longitude):
+    # Exact positions, in degrees, for an array of epochs
+    location = EarthLocation(lat=latitude*astro_units.deg, lon=longitude*astro_units.deg)
+    time = Time(epochs, format='unix')
+    altaz_frame = AltAz(obstime=time, location=location)
+    sun_position = get_sun(time).transform_to(altaz_frame)
+    return np.asarray(sun_position.az.deg, dtype=float), np.asarray(sun_position.alt.deg, dtype=float)
+
+def table_filename(latitude, longitude, quantum_s):
+    return CACHE_DIR + "solar_%.5f_%.5f_%d.npz" % (latitude, longitude, quantum_s)
+
+def load_table(fname):
+    if fname not in TABLES:
+        if os.path.exists(fname):
+            with np.load(fname) as data:
+                TABLES[fname] = { "first" : int(data["first"]), "azi" : data["azi"], "elev" : data["elev"] }
+        else:
+            TABLES[fname] = None
+    return TABLES[fname]
+
+def save_table(fname, table):
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    tmp = fname + ".tmp.npz"
+    np.savez(tmp, first=table["first"], azi=table["azi"], elev=table["elev"])
+    os.replace(tmp, fname)  # Atomic, so a half-written table is never seen
+    TABLES[fname] = table
+
+def extend_table(table, first, end, latitude, longitude, quantum_s):
+    # Grow the table (or create it) so it covers quanta first..end-1, calculating only the missing positions
+    if table is not None:
+        first = min(first, table["first"])
+        end = max(end, table["first"] + len(table["azi"]))
+    quanta = np.arange(first, end)
+    azi = np.full(len(quanta), np.nan)
+    elev = np.full(len(quanta), np.nan)
+    if table is not None:
+        offset = table["first"] - first
+        azi[offset:offset+len(table["azi"])] = table["azi"]
+        elev[offset:offset+len(table["elev"])] = table["elev"]
+    missing = np.isnan(azi)
+    print("Calculating",missing.sum(),"sun positions")
+    azi[missing], elev[missing] = calculate_azi_elev(quanta[missing] * float(quantum_s), latitude, longitude)
+    return { "first" : first, "azi" : azi, "elev" : elev }
+
+def epochs_to_azi_elev(epochs, latitude, longitude, quantum_s=QUANTUM_S):
+    # Returns arrays of azimuth and elevation (degrees) for an array of epochs, each rounded to the nearest quantum_s
+    quanta = np.rint(np.asarray(epochs, dtype=float) / quantum_s).astype(np.int64)
+    if len(quanta) == 0:
+        return np.zeros(0), np.zeros(0)
+    fname = table_filename(latitude, longitude, quantum_s)
+    table = load_table(fname)
+    first, end = int(quanta.min()), int(quanta.max()) + 1
+    if (table is None) or (first < table["first"]) or (end > table["first"] + len(table["azi"])):
+        table = extend_table(table, first, end, latitude, longitude, quantum_s)
+        save_table(fname, table)
+    idx = quanta - table["first"]
+    return table["azi"][idx], table["elev"][idx]
+
+if __name__ == "__main__":
+    import time
+    epochs = np.arange(1672531200, 1704067200, 60)    # Every minute of 2023
+    for attempt in range(2):
+        t1 = time.time()
+        azi, elev = epochs_to_azi_elev(epochs, 52.13674, 0.07688)
+        print("Found",len(azi),"positions in %1.3fs" % (time.time()-t1))
+    print("Max elevation %1.1f degrees" % elev.max())
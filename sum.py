@@ -1,67 +1,54 @@
-import json
-import glob
-import time
-
-COUNTS = {}
-SUMS = {}
-
-def process(fname):
-    global SUMS
-    f = json.loads(open(fname,"rt").read())
-    for reading in f["readings"]:
-        for (k,v) in reading.items():
-            if k in SUMS:
-                SUMS[k] += v
-                COUNTS[k] += 1
-            else:
-                SUMS[k] = v
-                COUNTS[k] = 1
-
-def dokey(reading):
-    if "reading_number" in reading:
-        return reading["reading_number"]
-    return 0
+# Totals of each metric over all our history, then all the readings as CSV, then daily PV totals
+# Reads from the archive (see archive.py), bringing it up to date first
 
-def do_dump(fname):
-    f = json.loads(open(fname, "rt").read())
-    readings = f["readings"]
-    for reading in sorted(readings, key = dokey):
-        print(fname, "," ,end="")
-        for k in SUMS.keys():
-            if k in reading:
-                print(reading[k],",", end="")
+import time
+from datetime import datetime, timezone
+import numpy as np
+import archive
+
+def sums(end):
+    # Returns { metric : (sum, count) }
+    result = {}
+    for metric in archive.METRICS:
+        a = archive.slots(metric, 0, end)
+        result[metric] = (float(np.nansum(a)), int((~np.isnan(a)).sum()))
+    return result
+
+def do_dump(end):
+    columns = [archive.slots(metric, 0, end) for metric in archive.METRICS]
+    has_data = np.zeros(end, dtype=bool)
+    for c in columns:
+        has_data |= ~np.isnan(c)
+    for slot in np.flatnonzero(has_data):
+        print(datetime.fromtimestamp(int(archive.slot_to_epoch(slot)), timezone.utc).isoformat(), "," ,end="")
+        for c in columns:
+            if not np.isnan(c[slot]):
+                print(c[slot],",", end="")
             else:
                 print(",", end="")
         print()
 
-def sum_pv(fname):
-    f = json.loads(open(fname, "rt").read())
-    readings = f["readings"]
-    sum = 0
-    for reading in readings:
-        if "pv" in reading:
-            sum += reading["pv"]
-    return sum
+def daily_sums(metric, dates):
+    a = archive.slots(metric, 0, archive.end_slot())
+    by_day = np.nansum(a.reshape(-1, archive.SLOTS_PER_DAY), axis=1)
+    return [by_day[archive.date_to_day(d)] for d in dates]
 
 if __name__ == "__main__":
-    files = sorted(list(glob.glob('../bc_data/readings*.json')))
-    print("Processing",len(files),"readings files")
-    print("Earliest",files[0])
-    print("Latest  ",files[-1])
-    for name in files: 
-        process(name)
+    archive.update()
+    dates = archive.dates()
+    end = archive.end_slot()
+    print("Processing",len(dates),"days of readings")
+    print("Earliest",dates[0])
+    print("Latest  ",dates[-1])
 
-    for (k,v) in SUMS.items():
-        print(k,v,"(",COUNTS[k],")","daily av:", v/len(files))
+    for (k,(v,count)) in sums(end).items():
+        print(k,v,"(",count,")","daily av:", v/len(dates))
 
     # Dump everything out
-    print("filename, ", ", ".join(SUMS.keys()))
+    print("datetime, ", ", ".join(archive.METRICS))
     time.sleep(1)
-    for name in files:
-       do_dump(name)
+    do_dump(end)
 
     print("Daily PV sums")
-    for name in files:
-        basename = name.split("_")[2]
-        basename = basename.split(".")[0]
-        print(basename, sum_pv(name))
+    for (date, pv) in zip(dates, daily_sums("pv", dates)):
+        print(date, pv)
@@ -0,0 +1,122 @@
+# One small record per day summarising its readings and weather, so that views of many days (e.g. the month view) needn't go through
+# every reading of every day. All the records are kept in one file (via filer), a day's record being written when the day rolls over,
+# and any past days we don't have a record for are filled-in the first time they're asked for (days with no files get a record too,
+# so we needn't keep looking for them). Each record holds the signatures of the day's files, and is redone if they change.
+
+import copy
+import time
+import datetime
+import filer
+
+TOTAL_KEYS = ["pv", "house", "import", "export", "batt charge", "batt discharge", "house pv",
+              "import cost at cheap", "import cost at expensive", "pv savings", "import savings"]
+
+CHECK_S = 10 * 60   # How often to check that a stored day's files haven't changed
+
+INDEX = None    # { "days" : { date : record } }. See summarise() and read_day()
+CHECKED = {}    # date : when we last checked its record's signatures
+
+def totals_for_day(readings):
+    def set_or_add(mydict, mykey, myvalue):
+        if mykey not in mydict:
+            mydict[mykey] = myvalue
+        else:
+            mydict[mykey] += myvalue
+    off_peak = {}
+    on_peak = {}
+    totals = {} # Totals is off-peak PLUS on-peak
+    for r in readings:
+        for (k,v) in r.items():
+            set_or_add(totals, k, v)
+            if r["cheap_rate"]:
+                set_or_add(off_peak, k, v)
+            else:
+                set_or_add(on_peak, k, v)
+
+    return (off_peak, on_peak, totals)
+
+def summarise(readings, weather):
+    # Either may be None if we don't have that file
+    record = {}
+    if readings is not None:
+        (off_peak, on_peak, totals) = totals_for_day(readings)
+        for (name, d) in [("off_peak", off_peak), ("on_peak", on_peak), ("totals", totals)]:
+            record[name] = { k : d[k] for k in TOTAL_KEYS if k in d }
+        battery = [r["battery %"] for r in readings if "battery %" in r]
+        if len(battery) > 0:
+            record["battery_min"] = min(battery)
+            record["battery_max"] = max(battery)
+    if weather is not None:
+        record["uv"] = sum([float(w["U"]) for w in weather if "U" in w])
+    return record
+
+def load():
+    global INDEX
+    if INDEX is None:
+        INDEX = { "days" : {} }
+        if filer.file_exists("summary", "index"):
+            INDEX = copy.deepcopy(filer.read_file("summary", "index"))  # We modify it
+    return INDEX
+
+def save():
+    filer.write_file("summary", "index", load())
+
+def signatures(date):
+    return [filer.signature("readings", date), filer.signature("weather", date)]
+
+def has_data(record):
+    return any(k != "signatures" for k in record)
+
+def read_day(date):
+    sigs = signatures(date)    # Before reading, so if a file changes meanwhile we'll pick that up next time
+    readings, weather = None, None
+    if sigs[0] != [None, None]:
+        readings = filer.read_file("readings", date)["readings"]
+    if sigs[1] != [None, None]:
+        weather = filer.read_file("weather", date)["raw"]
+    record = {}
+    if (readings is not None) or (weather is not None):
+        record = summarise(readings, weather)
+    record["signatures"] = sigs
+    return record
+
+def update_day(date):
+    # (Re)summarise a day, e.g. once it's over
+    load()["days"][date] = read_day(date)
+    CHECKED[date] = time.time()
+    save()
+
+def days_between(first_date, last_date):
+    # Returns { date : record } for every day from first_date to last_date inclusive for which we have any data.
+    # Today is still changing, so is summarised afresh every time rather than stored.
+    index = load()
+    today = datetime.datetime.utcnow().date().isoformat()
+    now = time.time()
+    result = {}
+    changed = 0
+    d = datetime.date.fromisoformat(first_date)
+    while d <= datetime.date.fromisoformat(last_date):
+        date = d.isoformat()
+        record = index["days"].get(date)
+        if date >= today:
+            record = read_day(date)
+        else:
+            check = now - CHECKED.get(date, 0) >= CHECK_S
+            if check:
+                CHECKED[date] = now
+            if (record is None) or (check and (record.get("signatures") != signatures(date))):
+                record = read_day(date)
+                index["days"][date] = record
+                changed += 1
+        if has_data(record):
+            result[date] = record
+        d += datetime.timedelta(days=1)
+    if changed > 0:
+        print("Summarised",changed,"days for summary index")
+        save()
+    return result
+
+if __name__ == "__main__":
+    import sys
+    for (date, record) in days_between(sys.argv[1], sys.argv[2]).items():  # python summary.py 2023-01-01 2023-01-31
+        print(date, record)
@@ -3,6 +3,7 @@ import datetime, time
 import urllib.request
 import math
 import traceback
+import numpy as np
 
 import utcstuff
 import config
@@ -48,13 +49,23 @@ MET_CODES = {
     }
 
 
+ONEHOT_ICONS = ["sun", "light cloud", "cloud", "light rain", "rain"]
+
+def _onehot_table():
+    # One row per Met Office code
+    table = np.zeros((len(MET_CODES), len(ONEHOT_ICONS)+1))
+    for code, m in MET_CODES.items():
+        if m["icon"] in ONEHOT_ICONS:
+            table[code, ONEHOT_ICONS.index(m["icon"])] = 1
+    return table
+ONEHOT_TABLE = _onehot_table()
+
 def code_to_onehot(code):
-    codes = ["sun", "light cloud", "cloud", "light rain", "rain"]
-    result = [0] * (len(codes)+1)
-    icon = MET_CODES[int(code)]["icon"]
-    if icon in codes:
-        result[codes.index(icon)] = 1
-    return result
+    return [int(v) for v in ONEHOT_TABLE[int(code)]]
+
+def codes_to_onehot(codes):
+    # Returns an array with one one-hot row per code
+    return ONEHOT_TABLE[np.asarray(codes, dtype=int)]
 
 def _read_metoffice(url):
     with urllib.request.urlopen(url + "&key=" + config.key("met_office")) as url: